@@ -39,6 +39,7 @@ import scipy.io
 import os
 import sys
 from random import shuffle
+from utils import apply_thread_config, load_image_shards
 
 SOURCE_URL = 'http://yann.lecun.com/exdb/mnist/'
 WORK_DIRECTORY = 'data'
@@ -155,6 +156,15 @@ def extract_transferred_data(filename, num_images):
   print('Extracting', filename)
   rgb_data = numpy.zeros([num_images, IMAGE_SIZE, IMAGE_SIZE, NUM_CHANNELS], numpy.float32)
 
+  if filename.endswith('_shards.npz'):
+    # shard export of the cyclegan test phase, in the same %08d.png order
+    images = load_image_shards(filename)[0]
+    for i in range(num_images):
+      for c in range(NUM_CHANNELS):
+        channel = Image.fromarray(images[i, :, :, c % images.shape[3]])
+        rgb_data[i, :, :, c] = channel.resize((IMAGE_SIZE, IMAGE_SIZE), Image.BILINEAR)
+    return (rgb_data - (PIXEL_DEPTH / 2.0)) / PIXEL_DEPTH
+
   for i in range(num_images):
       test_image = Image.open(filename + "%08d"%(i+1) +'.png')
       rgb_data[i, :, :, 0] = test_image.resize((IMAGE_SIZE, IMAGE_SIZE), Image.BILINEAR)
@@ -411,7 +421,8 @@ def main(_):
 
   # Create a local session to run the training.
   start_time = time.time()
-  with tf.Session() as sess:
+  # thread counts tuned for this host by main.py --phase autotune, if any
+  with tf.Session(config=apply_thread_config(tf.ConfigProto())) as sess:
     # Run all the initializers to prepare the trainable parameters.
     tf.global_variables_initializer().run()
     print('Initialized!')
@@ -494,7 +505,7 @@ if __name__ == '__main__':
       '--data_filename',
       type = str, 
       default= '/home/chen/Documents/cycleDA/cycleda-disentangle/test/in_weight10_noise_BtoA_23k/',
-      help='train or test data filename')
+      help='train or test data filename, or the <direction>_shards.npz index of a shard export')
   parser.add_argument(
       '--label_filename',
       type = str, 
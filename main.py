@@ -4,7 +4,8 @@ from datetime import datetime
 import pprint
 import tensorflow as tf
 tf.set_random_seed(19)
-from model import cyclegan
+from model import cyclegan, benchmark_instance_norm, check_data_format, num_cpu_devices, session_config
+from ops import set_data_format
 
 parser = argparse.ArgumentParser(description='')
 parser.add_argument('--dataset_dir', dest='dataset_dir', default='/home/chen/Documents/cycleDA/cycleda-disentangle/datasets', help='path of the dataset')
@@ -22,7 +23,7 @@ parser.add_argument('--output_style_dim', dest='output_style_dim', type=int, def
 parser.add_argument('--lr', dest='lr', type=float, default=0.0002, help='initial learning rate for adam')
 parser.add_argument('--beta1', dest='beta1', type=float, default=0.5, help='momentum term of adam')
 parser.add_argument('--which_direction', dest='which_direction', default='BtoA', help='AtoB or BtoA')
-parser.add_argument('--phase', dest='phase', default='train', help='train, test')
+parser.add_argument('--phase', dest='phase', default='train', help='train, test, benchmark, autotune, layout_check, norm_benchmark')
 parser.add_argument('--save_freq', dest='save_freq', type=int, default=1000, help='save a model every save_freq iterations')
 parser.add_argument('--print_freq', dest='print_freq', type=int, default=100, help='print the debug information every print_freq iterations')
 parser.add_argument('--continue_train', dest='continue_train', type=bool, default=False, help='if continue training, load the latest model: 1: true, 0: false')
@@ -34,10 +35,47 @@ parser.add_argument('--L1_lambda', dest='L1_lambda', type=float, default=10.0, h
 parser.add_argument('--style_weight', dest='style_weight', type=float, default=10.0, help='weight on style loss in objective')
 parser.add_argument('--use_resnet', dest='use_resnet', type=bool, default=False, help='generation network using reidule block')
 parser.add_argument('--use_lsgan', dest='use_lsgan', type=bool, default=False, help='gan loss defined in lsgan')
-parser.add_argument('--max_size', dest='max_size', type=int, default=50, help='max size of image pool, 0 means do not use image pool')
+parser.add_argument('--max_size', dest='max_size', type=int, default=50, help='max size of image pool in batches, 0 means do not use image pool')
 parser.add_argument('--exp_id', dest='exp_id', type=str, default=datetime.now().strftime('%m%d%H%M%S'), help='experiment id, will be appened to all the dir')
-parser.add_argument('--normalization', dest='normalization', type=str, default='IN', help='normalization method to choose: batch normalization (BN) or instance normalization (IN)')
+parser.add_argument('--normalization', dest='normalization', type=str, default='BN', choices=['BN', 'IN'], help='generator normalization: batch normalization (BN) or instance normalization (IN, fused kernel); the discriminators always use BN')
 parser.add_argument('--add_noise', dest='add_noise', type=bool, default=True, help='add additive gaussian noise to fake images')
+parser.add_argument('--use_cache', dest='use_cache', type=bool, default=False, help='decode the datasets once into memory-mapped uint8 arrays and read batches from them')
+parser.add_argument('--cache_dir', dest='cache_dir', default='./cache', help='decoded dataset cache and file manifests are saved here')
+parser.add_argument('--num_workers', dest='num_workers', type=int, default=4, help='# of workers assembling training batches in the background')
+parser.add_argument('--prefetch_depth', dest='prefetch_depth', type=int, default=8, help='# of training batches prepared ahead of the current step')
+parser.add_argument('--prefetch_processes', dest='prefetch_processes', type=bool, default=False, help='decode batches in worker processes instead of threads')
+parser.add_argument('--input_mode', dest='input_mode', default='dataset', help='training input: dataset (in-graph tf.data pipeline) or feed (feed_dict from the prefetcher)')
+parser.add_argument('--sample_pool_size', dest='sample_pool_size', type=int, default=1024, help='# of test image pairs decoded once at startup for sample_model')
+parser.add_argument('--fixed_sample', dest='fixed_sample', type=bool, default=False, help='sample the same test batch at every print_freq step')
+parser.add_argument('--num_writers', dest='num_writers', type=int, default=2, help='# of background threads encoding and writing sample/test images')
+parser.add_argument('--writer_queue_size', dest='writer_queue_size', type=int, default=256, help='max # of image writes waiting for a writer thread')
+parser.add_argument('--test_batch_size', dest='test_batch_size', type=int, default=256, help='# images translated per session run in test phase')
+parser.add_argument('--test_output', dest='test_output', default='png', help='test phase output: png (one image per input plus html index) or shards (uint8 .npy shards with an index)')
+parser.add_argument('--shard_size', dest='shard_size', type=int, default=10000, help='# images per shard with --test_output shards')
+parser.add_argument('--shard_label_file', dest='shard_label_file', default='', help='.mat file whose y field labels the <index>.png inputs of the shards, e.g. SVHN test_32x32.mat')
+parser.add_argument('--uint8_input', dest='uint8_input', type=bool, default=False, help='feed real images as uint8 pixels and normalize them in the graph')
+parser.add_argument('--fused_step', dest='fused_step', type=bool, default=False, help='run the G and D updates in one session call with an in-graph image pool')
+parser.add_argument('--warmup_steps', dest='warmup_steps', type=int, default=5, help='# of untimed steps before the benchmark and autotune phases measure')
+parser.add_argument('--benchmark_steps', dest='benchmark_steps', type=int, default=50, help='# of timed training steps in benchmark phase and per thread setting in autotune phase')
+parser.add_argument('--scalar_summary_freq', dest='scalar_summary_freq', type=int, default=10, help='write loss summaries every scalar_summary_freq iterations, 0 to disable')
+parser.add_argument('--image_summary_freq', dest='image_summary_freq', type=int, default=0, help='write real/fake image summaries every image_summary_freq iterations, 0 to disable')
+parser.add_argument('--histogram_summary_freq', dest='histogram_summary_freq', type=int, default=0, help='write weight histograms every histogram_summary_freq iterations, 0 to disable')
+parser.add_argument('--batch_discriminator', dest='batch_discriminator', type=bool, default=False, help='evaluate real and fake inputs of each discriminator in one batched call')
+parser.add_argument('--batch_generator', dest='batch_generator', type=bool, default=False, help='run both generatorA2B passes in one batched call')
+parser.add_argument('--xla', dest='xla', type=bool, default=False, help='JIT compile the training and test graphs with XLA')
+parser.add_argument('--data_format', dest='data_format', default='NHWC', help='layout of the image tensors inside the networks: NHWC or NCHW')
+parser.add_argument('--recompute', dest='recompute', type=bool, default=False, help='recompute generator block activations during backprop instead of keeping them, to save memory')
+parser.add_argument('--num_towers', dest='num_towers', type=int, default=1, help='# of devices the batch is split across, each with its own copy of the networks')
+parser.add_argument('--tower_device', dest='tower_device', default='cpu', help='device type of the towers: cpu or gpu')
+parser.add_argument('--pool_dtype', dest='pool_dtype', default='float32', help='storage type of the image pool: float32, float16 or uint8')
+parser.add_argument('--pool_backend', dest='pool_backend', default='memory', help='image pool of the two-call training step: memory (numpy ImagePool, fakes round-trip through Python), disk (ImagePool in a memory-mapped file, for large max_size) or graph (local variables, fakes stay in the session)')
+parser.add_argument('--pool_dir', dest='pool_dir', default='./pool', help='directory of the memory-mapped files of --pool_backend disk')
+parser.add_argument('--pool_hot_size', dest='pool_hot_size', type=int, default=4096, help='# images per domain kept in RAM by --pool_backend disk before they are written to the file')
+parser.add_argument('--async_checkpoint', dest='async_checkpoint', type=bool, default=False, help='snapshot variables in memory and write checkpoints from a background thread')
+parser.add_argument('--keep_last', dest='keep_last', type=int, default=100, help='# of most recent checkpoints to keep, 0 keeps all')
+parser.add_argument('--keep_every', dest='keep_every', type=int, default=0, help='also keep the first checkpoint of every this many steps, 0 disables')
+parser.add_argument('--keep_best_metric', dest='keep_best_metric', default='', help='also keep the checkpoint with the lowest value of this loss on a sample batch: g_loss, d_loss, or a term such as g_loss_a2b or da_loss')
+parser.add_argument('--save_generator', dest='save_generator', type=bool, default=False, help='also save generator weights only under <checkpoint_dir>/generator')
 args = parser.parse_args()
 
 
@@ -68,12 +106,27 @@ def main(_):
 
 
 
-    tfconfig = tf.ConfigProto(allow_soft_placement=True)
-    tfconfig.gpu_options.allow_growth = True
+    set_data_format(args.data_format)
+    if args.phase == 'layout_check':
+        # builds its own NHWC and NCHW graphs
+        if not check_data_format(args):
+            raise SystemExit('NCHW outputs differ from NHWC')
+        return
+    if args.phase == 'norm_benchmark':
+        benchmark_instance_norm(args)
+        return
+
+    tfconfig = session_config(args.xla, num_cpu_devices=num_cpu_devices(args))
     with tf.Session(config=tfconfig) as sess:
         model = cyclegan(sess, args)
-        model.train(args) if args.phase == 'train' \
-            else model.test(args)
+        if args.phase == 'train':
+            model.train(args)
+        elif args.phase == 'benchmark':
+            model.benchmark(args)
+        elif args.phase == 'autotune':
+            model.autotune(args)
+        else:
+            model.test(args)
 
 if __name__ == '__main__':
     tf.app.run()
@@ -1,7 +1,8 @@
 from __future__ import division
+import glob
+import multiprocessing
 import os
 import time
-from glob import glob
 import tensorflow as tf
 import numpy as np
 from collections import namedtuple
@@ -9,6 +10,121 @@ from collections import namedtuple
 from module import *
 from utils import *
 
+# scalar losses of the model, set on each tower and averaged on the model
+LOSS_NAMES = ['g_loss_a2b', 'g_loss_b2a', 'g_loss_style', 'g_loss', 'db_loss_real', 'db_loss_fake',
+              'db_loss', 'da_loss_real', 'da_loss_fake', 'da_loss', 'd_loss']
+
+
+def session_config(xla=False, threads=None, num_cpu_devices=1):
+    """Session config for main.py and the benchmark and autotune sessions.
+
+    threads is an (intra_op, inter_op) pair, by default the tuned counts of this host.
+    """
+    tfconfig = tf.ConfigProto(allow_soft_placement=True)
+    tfconfig.gpu_options.allow_growth = True
+    if num_cpu_devices > 1:
+        tfconfig.device_count['CPU'] = num_cpu_devices
+    if threads is None:
+        apply_thread_config(tfconfig)
+    else:
+        tfconfig.intra_op_parallelism_threads, tfconfig.inter_op_parallelism_threads = threads
+    if xla:
+        # CPU auto-clustering is only switched on through TF_XLA_FLAGS, read by the first session
+        flags = os.environ.get('TF_XLA_FLAGS', '')
+        if '--tf_xla_cpu_global_jit' not in flags:
+            os.environ['TF_XLA_FLAGS'] = (flags + ' --tf_xla_cpu_global_jit').strip()
+        tfconfig.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    return tfconfig
+
+
+def random_batch(args):
+    """One random training batch in the input format of the model: real_A and real_B stacked on channels."""
+    shape = [args.batch_size, args.fine_size, args.fine_size, args.input_nc + args.output_nc]
+    if args.uint8_input:
+        return np.random.randint(0, 256, shape).astype(np.uint8)
+    return np.random.uniform(-1., 1., shape).astype(np.float32)
+
+
+def check_data_format(args, tolerance=1e-4):
+    """Compare NCHW against NHWC outputs on the same weights and batch; True if within tolerance."""
+    batch_images = random_batch(args)
+    names = ['real_A', 'fake_A', 'recon_A', 'real_B', 'fake_B', 'recon_B', 'fake_B_style']
+    outputs, weights = {}, None
+    try:
+        for data_format in ['NHWC', 'NCHW']:
+            set_data_format(data_format)
+            with tf.Graph().as_default(), tf.Session(config=session_config(args.xla, num_cpu_devices=num_cpu_devices(args))) as sess:
+                model = cyclegan(sess, args)
+                sess.run(tf.group(tf.global_variables_initializer(), tf.local_variables_initializer()))
+                if weights is None:
+                    weights = sess.run(dict((var.op.name, var) for var in tf.global_variables()))
+                else:
+                    for var in tf.global_variables():
+                        var.load(weights[var.op.name], sess)
+                fetches = model.sample_outputs + [model.fake_B_style]
+                outputs[data_format] = [sess.run(fetches, feed_dict={model.real_data: batch_images,
+                                                                     model.is_training: is_training})
+                                        for is_training in [False, True]]
+                model.image_writer.close()
+    finally:
+        set_data_format(args.data_format)
+
+    passed = True
+    for mode, nhwc, nchw in zip(['inference', 'training'], outputs['NHWC'], outputs['NCHW']):
+        for name, expected, actual in zip(names, nhwc, nchw):
+            diff = float(np.max(np.abs(expected - actual)))
+            passed = passed and diff <= tolerance
+            print(" [{0}] {1} {2}: max abs diff {3:.2e}".format(
+                '*' if diff <= tolerance else '!', mode, name, diff))
+    return passed
+
+
+def benchmark_instance_norm(args):
+    """Time fused against reference ops.instance_norm on the generator activation shapes."""
+    shapes = [(args.fine_size // 2, args.fine_size // 2, args.ngf),
+              (args.fine_size // 4, args.fine_size // 4, args.ngf * 2)]
+    for h, w, c in shapes:
+        shape = [args.batch_size] + layout_dims(h, w, c)
+        with tf.Graph().as_default(), tf.Session(config=session_config(args.xla, num_cpu_devices=num_cpu_devices(args))) as sess:
+            x = tf.Variable(tf.random_normal(shape), name='x')
+            upstream = tf.random_normal(shape, seed=1)
+            results = {}
+            for fused in [False, True]:
+                scope = 'fused' if fused else 'reference'
+                y = instance_norm(x, scope, fused=fused)
+                grads = tf.gradients(y, [x] + tf.trainable_variables(scope), grad_ys=upstream)
+                results[fused] = (y, tf.group(y), grads, tf.group(*grads))
+            sess.run(tf.global_variables_initializer())
+            # same scale and offset for both paths
+            sess.run([tf.assign(fused_var, reference_var) for reference_var, fused_var in
+                      zip(tf.trainable_variables('reference'), tf.trainable_variables('fused'))])
+
+            timings = {}
+            for fused, (y, forward, grads, backward) in results.items():
+                for name, op in [('forward', forward), ('backward', backward)]:
+                    for _ in range(args.warmup_steps):
+                        sess.run(op)
+                    start_time = time.time()
+                    for _ in range(args.benchmark_steps):
+                        sess.run(op)
+                    timings[fused, name] = (time.time() - start_time) / max(args.benchmark_steps, 1)
+            reference, fused = sess.run([[results[False][0]] + results[False][2], [results[True][0]] + results[True][2]])
+            diff = max(float(np.max(np.abs(a - b))) for a, b in zip(reference, fused))
+
+        print(" [*] instance_norm {0}: reference forward {1:.3f} ms backward {2:.3f} ms, "
+              "fused forward {3:.3f} ms backward {4:.3f} ms, max abs diff {5:.2e}".format(
+                  shape, 1000 * timings[False, 'forward'], 1000 * timings[False, 'backward'],
+                  1000 * timings[True, 'forward'], 1000 * timings[True, 'backward'], diff))
+
+
+def num_cpu_devices(args):
+    return args.num_towers if args.tower_device == 'cpu' else 1
+
+
+class Tower(object):
+    """Tensors of one data-parallel copy of the networks, see cyclegan._build_towers."""
+    pass
+
 
 class cyclegan(object):
     def __init__(self, sess, args):
@@ -21,6 +137,25 @@ class cyclegan(object):
         self.dataset_dir = args.dataset_dir
         self.style_weight = args.style_weight
         self.add_noise = args.add_noise
+        self.use_cache = args.use_cache
+        self.cache_dir = args.cache_dir
+        self.input_mode = args.input_mode if args.phase == 'train' else 'feed'
+        self.num_workers = args.num_workers
+        self.prefetch_depth = args.prefetch_depth
+        self.uint8_input = args.uint8_input
+        self.fused_step = args.fused_step
+        self.batch_discriminator = args.batch_discriminator
+        self.batch_generator = args.batch_generator
+        self.summary_freq = {'scalars': args.scalar_summary_freq,
+                             'images': args.image_summary_freq,
+                             'histograms': args.histogram_summary_freq}
+        self.pool_capacity = args.max_size * args.batch_size
+        # the fused step always keeps its pool in the graph
+        self.pool_backend = 'graph' if args.fused_step else args.pool_backend
+        self.num_towers = args.num_towers
+        self.tower_devices = ['/{0}:{1}'.format(args.tower_device, i) for i in range(args.num_towers)]
+        if args.batch_size % args.num_towers:
+            raise ValueError('--batch_size must be a multiple of --num_towers')
         
 
         self.discriminator = discriminator
@@ -39,78 +174,107 @@ class cyclegan(object):
 
         OPTIONS = namedtuple('OPTIONS', 'batch_size image_size \
                               gf_dim df_dim input_c_dim output_c_dim output_style_dim \
-                              use_bn is_training')
+                              use_bn is_training recompute')
         self.options = OPTIONS._make((args.batch_size, args.fine_size,
                                       args.ngf, args.ndf, args.input_nc, args.output_nc,
-                                      args.output_style_dim, args.normalization, args.phase == 'train'))
+                                      args.output_style_dim, args.normalization == 'BN', args.phase == 'train',
+                                      args.recompute))
 
         self._build_model()
         self.saver = tf.train.Saver(var_list=tf.global_variables(), max_to_keep=100)
-        self.pool = ImagePool(args.max_size)
+        # network weights only, for checkpoints written without optimizer state
+        self.weights_saver = self.saver
+        self.generator_saver = tf.train.Saver(var_list=self._generator_variables(tf.global_variables()))
+        self.keep_last = args.keep_last
+        self.keep_every = args.keep_every
+        self.keep_best_metric = args.keep_best_metric
+        self.checkpoint_queue = None
+        if self.pool_backend == 'disk':
+            self.pool = DiskImagePool(self.pool_capacity, args.pool_dtype, args.pool_dir, args.pool_hot_size)
+        else:
+            self.pool = ImagePool(self.pool_capacity, args.pool_dtype)
+        self.image_writer = BackgroundWriter(args.num_writers, args.writer_queue_size)
 
-    def _build_model(self):
-        self.real_data = tf.placeholder(tf.float32,
-                                        [None, self.image_size, self.image_size,
-                                         self.input_c_dim + self.output_c_dim],
-                                        name='real_A_and_B_images')
+    def _build_input_pipeline(self):
+        """Read real_A and real_B from a tf.data pipeline fed once per epoch through epoch_A/epoch_B.
 
-        # A: MNIST 
-        # B: SVHN
-        self.real_A = self.real_data[:, :, :, :self.input_c_dim]
-        self.real_B = self.real_data[:, :, :, self.input_c_dim: self.input_c_dim + self.output_c_dim]
+        real_data still accepts a feed, which is how sample_model uses it.
+        """
+        real_shape = [self.batch_size, self.image_size, self.image_size,
+                      self.input_c_dim + self.output_c_dim]
+        real_dtype = tf.uint8 if self.uint8_input else tf.float32
 
-        self.is_training = tf.placeholder(tf.bool, [], name='is_training')
+        def decode(path, is_grayscale, channels):
+            # the decoder of load_train_data and the cache, so all input modes see the same pixels
+            img = tf.py_func(lambda p: decode_image(p, self.image_size, is_grayscale), [path], tf.uint8,
+                             stateful=False)
+            img.set_shape([self.image_size, self.image_size, channels])
+            return img if self.uint8_input else tf.to_float(img)/127.5 - 1.
 
-        #S -> M' + style' -> S_hat
-        #real_B -> fake_A + fake_B_style -> fake_B_
-        self.fake_A, self.fake_B_style = self.generator_B2A(self.real_B, self.options, False, is_training=self.is_training, name="generatorB2A")
-        self.noise = tf.zeros(tf.shape(self.fake_A), dtype=tf.float32)
-        if self.add_noise and self.is_training is True:
-            self.noise = tf.random_normal(tf.shape(self.fake_A), mean=0.0, stddev=0.1, dtype=tf.float32)
-        self.fake_B_ = self.generator_A2B(self.fake_A + self.noise, self.fake_B_style, self.options, False, is_training=self.is_training, name="generatorA2B")
+        if self.use_cache:
+            self.epoch_A = tf.placeholder(tf.int64, [None], name='epoch_A')
+            self.epoch_B = tf.placeholder(tf.int64, [None], name='epoch_B')
+            dataset = tf.data.Dataset.zip((tf.data.Dataset.from_tensor_slices(self.epoch_A),
+                                           tf.data.Dataset.from_tensor_slices(self.epoch_B)))
+            dataset = dataset.batch(self.batch_size, drop_remainder=True)
+            dataset = dataset.map(
+                lambda idx_A, idx_B: tf.py_func(
+                    lambda a, b: load_cached_batch(self.cache['trainA'], self.cache['trainB'], a, b,
+                                                   as_uint8=self.uint8_input),
+                    [idx_A, idx_B], real_dtype, stateful=False),
+                num_parallel_calls=self.num_workers)
+        else:
+            self.epoch_A = tf.placeholder(tf.string, [None], name='epoch_A')
+            self.epoch_B = tf.placeholder(tf.string, [None], name='epoch_B')
+            dataset_A = tf.data.Dataset.from_tensor_slices(self.epoch_A).map(
+                lambda path: decode(path, True, self.input_c_dim), num_parallel_calls=self.num_workers)
+            dataset_B = tf.data.Dataset.from_tensor_slices(self.epoch_B).map(
+                lambda path: decode(path, False, self.output_c_dim), num_parallel_calls=self.num_workers)
+            dataset = tf.data.Dataset.zip((dataset_A, dataset_B)).map(lambda img_A, img_B: tf.concat([img_A, img_B], 2))
+            dataset = dataset.batch(self.batch_size, drop_remainder=True)
+        dataset = dataset.prefetch(self.prefetch_depth)
+        self.data_iterator = dataset.make_initializable_iterator()
 
-        #M + style' -> S'-> M_hat + style_hat
-        #real_A + fake_B_style -> fake_B -> fake_A_ + fake_B_style_
-        self.fake_B = self.generator_A2B(self.real_A, self.fake_B_style, self.options, True, is_training=self.is_training, name="generatorA2B")
-        self.noise = tf.zeros(tf.shape(self.fake_B), dtype=tf.float32)
-        if self.add_noise and self.is_training is True:
-            self.noise = tf.random_normal(shape=tf.shape(self.fake_B), mean=0.0, stddev=0.1, dtype=tf.float32)
-        self.fake_A_, self.fake_B_style_ = self.generator_B2A(self.fake_B + self.noise, self.options, True, is_training=self.is_training, name="generatorB2A")
-        
+        if self.fused_step:
+            # the single train_op call pulls its batch straight from the iterator
+            self.load_batch = None
+            batch = tf.reshape(self.data_iterator.get_next(), real_shape)
+        else:
+            # staged by load_batch, so the G and D calls of one step read the same batch
+            batch = tf.get_variable('real_A_and_B_batch', real_shape, real_dtype,
+                                    initializer=tf.zeros_initializer(), trainable=False,
+                                    collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            self.load_batch = tf.assign(batch, tf.reshape(self.data_iterator.get_next(), real_shape))
+        self.real_data = tf.placeholder_with_default(tf.identity(batch), [None] + real_shape[1:],
+                                                     name='real_A_and_B_images')
 
-        self.DB_fake = self.discriminator(self.fake_B, self.options, reuse=False, is_training=self.is_training, name="discriminatorB")
-        self.DA_fake = self.discriminator(self.fake_A, self.options, reuse=False, is_training=self.is_training, name="discriminatorA")
-        self.g_loss_a2b = self.criterionGAN(self.DB_fake, tf.ones_like(self.DB_fake)) \
-            + self.L1_lambda * abs_criterion(self.real_A, self.fake_A_) \
-            + self.L1_lambda * abs_criterion(self.real_B, self.fake_B_)
-        self.g_loss_b2a = self.criterionGAN(self.DA_fake, tf.ones_like(self.DA_fake)) \
-            + self.L1_lambda * abs_criterion(self.real_A, self.fake_A_) \
-            + self.L1_lambda * abs_criterion(self.real_B, self.fake_B_)
-        self.g_loss_style = self.style_weight * abs_criterion(self.fake_B_style, self.fake_B_style_)
-        self.g_loss = self.criterionGAN(self.DA_fake, tf.ones_like(self.DA_fake)) \
-            + self.criterionGAN(self.DB_fake, tf.ones_like(self.DB_fake)) \
-            + self.L1_lambda * abs_criterion(self.real_A, self.fake_A_) \
-            + self.L1_lambda * abs_criterion(self.real_B, self.fake_B_) \
-            + self.style_weight * abs_criterion(self.fake_B_style, self.fake_B_style_)
-
-        self.fake_A_sample = tf.placeholder(tf.float32,
-                                            [None, self.image_size, self.image_size,
-                                             self.input_c_dim], name='fake_A_sample')
-        self.fake_B_sample = tf.placeholder(tf.float32,
+    def _build_model(self):
+        if self.input_mode == 'dataset':
+            self._build_input_pipeline()
+        else:
+            self.real_data = tf.placeholder(tf.uint8 if self.uint8_input else tf.float32,
                                             [None, self.image_size, self.image_size,
-                                             self.output_c_dim], name='fake_B_sample')
-        self.DB_real = self.discriminator(self.real_B, self.options, reuse=True, is_training=self.is_training, name="discriminatorB")
-        self.DA_real = self.discriminator(self.real_A, self.options, reuse=True, is_training=self.is_training, name="discriminatorA")
-        self.DB_fake_sample = self.discriminator(self.fake_B_sample, self.options, reuse=True, is_training=self.is_training, name="discriminatorB")
-        self.DA_fake_sample = self.discriminator(self.fake_A_sample, self.options, reuse=True, is_training=self.is_training, name="discriminatorA")
-
-        self.db_loss_real = self.criterionGAN(self.DB_real, tf.ones_like(self.DB_real))
-        self.db_loss_fake = self.criterionGAN(self.DB_fake_sample, tf.zeros_like(self.DB_fake_sample))
-        self.db_loss = (self.db_loss_real + self.db_loss_fake) / 2
-        self.da_loss_real = self.criterionGAN(self.DA_real, tf.ones_like(self.DA_real))
-        self.da_loss_fake = self.criterionGAN(self.DA_fake_sample, tf.zeros_like(self.DA_fake_sample))
-        self.da_loss = (self.da_loss_real + self.da_loss_fake) / 2
-        self.d_loss = self.da_loss + self.db_loss
+                                             self.input_c_dim + self.output_c_dim],
+                                            name='real_A_and_B_images')
+        if self.uint8_input:
+            # pixels arrive as uint8 and are cast and normalized to [-1, 1] in the graph
+            real_data = tf.to_float(self.real_data)/127.5 - 1.
+        else:
+            real_data = self.real_data
+
+        # A: MNIST 
+        # B: SVHN
+        # the networks run in ops.DATA_FORMAT; fed and fetched images stay NHWC
+        self.is_training = tf.placeholder(tf.bool, [], name='is_training')
+        if self.num_towers == 1:
+            self.real_A = to_data_format(real_data[:, :, :, :self.input_c_dim])
+            self.real_B = to_data_format(real_data[:, :, :, self.input_c_dim: self.input_c_dim + self.output_c_dim])
+            self._build_generators(self, False)
+            self._build_fake_samples()
+            self._build_discriminators(self, False)
+            self._build_losses(self)
+        else:
+            self._build_towers(real_data)
 
        
 
@@ -133,6 +297,15 @@ class cyclegan(object):
              self.d_loss_sum]
         )
 
+        def to_uint8(images):
+            return tf.cast(tf.clip_by_value((from_data_format(images) + 1.) * 127.5, 0., 255.), tf.uint8)
+        self.image_sum = tf.summary.merge(
+            [tf.summary.image("real_A", to_uint8(self.real_A), max_outputs=4),
+             tf.summary.image("fake_B", to_uint8(self.fake_B), max_outputs=4),
+             tf.summary.image("real_B", to_uint8(self.real_B), max_outputs=4),
+             tf.summary.image("fake_A", to_uint8(self.fake_A), max_outputs=4)]
+        )
+
         self.test_A = tf.placeholder(tf.float32,
                                      [None, self.image_size, self.image_size,
                                       self.input_c_dim], name='test_A')
@@ -140,7 +313,11 @@ class cyclegan(object):
                                      [None, self.image_size, self.image_size,
                                       self.output_c_dim], name='test_B')
         
-        self.testA, self.test_B_style = self.generator_B2A(self.test_B, self.options, True, is_training=self.is_training, name="generatorB2A")
+        self.testA, self.test_B_style = self.generator_B2A(to_data_format(self.test_B), self.options, True, is_training=self.is_training, name="generatorB2A")
+        self.testA = from_data_format(self.testA)
+        # NHWC copies of the images saved by sample_model
+        self.sample_outputs = [from_data_format(images) for images in
+                               [self.real_A, self.fake_A, self.fake_A_, self.real_B, self.fake_B, self.fake_B_]]
         #self.testB = self.generator_A2B(self.test_A, self.test_B_style, self.options, True, is_training=self.is_training, name="generatorA2B")
         
         t_vars = tf.trainable_variables()
@@ -148,113 +325,642 @@ class cyclegan(object):
         self.g_vars = [var for var in t_vars if 'generator' in var.name]
 
         for var in t_vars: print(var.name)
+        self.histogram_sum = tf.summary.merge(
+            [tf.summary.histogram(var.name.replace(':', '_'), var) for var in t_vars])
+
+    def _build_generators(self, t, reuse):
+        """Generator passes of one tower t, which is the model itself with a single tower."""
+        #S -> M' + style' -> S_hat
+        #real_B -> fake_A + fake_B_style -> fake_B_
+        t.fake_A, t.fake_B_style = self.generator_B2A(t.real_B, self.options, reuse, is_training=self.is_training, name="generatorB2A")
+        t.noise = tf.zeros(tf.shape(t.fake_A), dtype=tf.float32)
+        if self.add_noise and self.is_training is True:
+            t.noise = tf.random_normal(tf.shape(t.fake_A), mean=0.0, stddev=0.1, dtype=tf.float32)
+        if self.batch_generator:
+            #both generatorA2B passes share weights and fake_B_style, so they run as one batch:
+            #[fake_A + noise; real_A] + [fake_B_style; fake_B_style] -> [fake_B_; fake_B]
+            splits = [tf.shape(t.fake_A)[0], tf.shape(t.real_A)[0]]
+            fake_Bs = self.generator_A2B(tf.concat([t.fake_A + t.noise, t.real_A], 0),
+                                         tf.concat([t.fake_B_style, t.fake_B_style], 0),
+                                         self.options, reuse, is_training=self.is_training,
+                                         name="generatorA2B", splits=splits)
+            t.fake_B_, t.fake_B = tf.split(fake_Bs, tf.stack(splits), num=2)
+        else:
+            t.fake_B_ = self.generator_A2B(t.fake_A + t.noise, t.fake_B_style, self.options, reuse, is_training=self.is_training, name="generatorA2B")
+
+            #M + style' -> S'-> M_hat + style_hat
+            #real_A + fake_B_style -> fake_B -> fake_A_ + fake_B_style_
+            t.fake_B = self.generator_A2B(t.real_A, t.fake_B_style, self.options, True, is_training=self.is_training, name="generatorA2B")
+        t.noise = tf.zeros(tf.shape(t.fake_B), dtype=tf.float32)
+        if self.add_noise and self.is_training is True:
+            t.noise = tf.random_normal(shape=tf.shape(t.fake_B), mean=0.0, stddev=0.1, dtype=tf.float32)
+        t.fake_A_, t.fake_B_style_ = self.generator_B2A(t.fake_B + t.noise, self.options, True, is_training=self.is_training, name="generatorB2A")
+
+    def _build_fake_samples(self):
+        if self.fused_step:
+            # the discriminators read their history from the graph, so no fakes go through Python
+            self.fake_A_sample = tf.placeholder_with_default(
+                self._history_buffer(self.fake_A, 'fake_A_pool'),
+                [None] + layout_dims(self.image_size, self.image_size, self.input_c_dim), name='fake_A_sample')
+            self.fake_B_sample = tf.placeholder_with_default(
+                self._history_buffer(self.fake_B, 'fake_B_pool'),
+                [None] + layout_dims(self.image_size, self.image_size, self.output_c_dim), name='fake_B_sample')
+        elif self.pool_backend == 'graph':
+            # the G call of train_step runs store_fake_samples, the D call reads what it stored
+            fake_A_batch, store_A = self._pooled_batch(self.fake_A, 'fake_A_pool')
+            fake_B_batch, store_B = self._pooled_batch(self.fake_B, 'fake_B_pool')
+            self.store_fake_samples = tf.group(store_A, store_B)
+            self.fake_A_sample = tf.placeholder_with_default(
+                fake_A_batch, [None] + layout_dims(self.image_size, self.image_size, self.input_c_dim),
+                name='fake_A_sample')
+            self.fake_B_sample = tf.placeholder_with_default(
+                fake_B_batch, [None] + layout_dims(self.image_size, self.image_size, self.output_c_dim),
+                name='fake_B_sample')
+        else:
+            # fed back from the ImagePool with what train_step fetched, so in ops.DATA_FORMAT
+            self.fake_A_sample = tf.placeholder(tf.float32,
+                                                [None] + layout_dims(self.image_size, self.image_size,
+                                                                     self.input_c_dim), name='fake_A_sample')
+            self.fake_B_sample = tf.placeholder(tf.float32,
+                                                [None] + layout_dims(self.image_size, self.image_size,
+                                                                     self.output_c_dim), name='fake_B_sample')
+
+    def _build_discriminators(self, t, reuse):
+        if self.batch_discriminator:
+            if self.fused_step:
+                # all three inputs of each discriminator are evaluated in the same session run
+                t.DB_fake, t.DB_real, t.DB_fake_sample = self._discriminate(
+                    [t.fake_B, t.real_B, t.fake_B_sample], reuse, "discriminatorB")
+                t.DA_fake, t.DA_real, t.DA_fake_sample = self._discriminate(
+                    [t.fake_A, t.real_A, t.fake_A_sample], reuse, "discriminatorA")
+            else:
+                t.DB_fake = self.discriminator(t.fake_B, self.options, reuse=reuse, is_training=self.is_training, name="discriminatorB")
+                t.DA_fake = self.discriminator(t.fake_A, self.options, reuse=reuse, is_training=self.is_training, name="discriminatorA")
+                t.DB_real, t.DB_fake_sample = self._discriminate(
+                    [t.real_B, t.fake_B_sample], True, "discriminatorB")
+                t.DA_real, t.DA_fake_sample = self._discriminate(
+                    [t.real_A, t.fake_A_sample], True, "discriminatorA")
+        else:
+            t.DB_fake = self.discriminator(t.fake_B, self.options, reuse=reuse, is_training=self.is_training, name="discriminatorB")
+            t.DA_fake = self.discriminator(t.fake_A, self.options, reuse=reuse, is_training=self.is_training, name="discriminatorA")
+            t.DB_real = self.discriminator(t.real_B, self.options, reuse=True, is_training=self.is_training, name="discriminatorB")
+            t.DA_real = self.discriminator(t.real_A, self.options, reuse=True, is_training=self.is_training, name="discriminatorA")
+            t.DB_fake_sample = self.discriminator(t.fake_B_sample, self.options, reuse=True, is_training=self.is_training, name="discriminatorB")
+            t.DA_fake_sample = self.discriminator(t.fake_A_sample, self.options, reuse=True, is_training=self.is_training, name="discriminatorA")
+
+    def _build_losses(self, t):
+        t.g_loss_a2b = self.criterionGAN(t.DB_fake, tf.ones_like(t.DB_fake)) \
+            + self.L1_lambda * abs_criterion(t.real_A, t.fake_A_) \
+            + self.L1_lambda * abs_criterion(t.real_B, t.fake_B_)
+        t.g_loss_b2a = self.criterionGAN(t.DA_fake, tf.ones_like(t.DA_fake)) \
+            + self.L1_lambda * abs_criterion(t.real_A, t.fake_A_) \
+            + self.L1_lambda * abs_criterion(t.real_B, t.fake_B_)
+        t.g_loss_style = self.style_weight * abs_criterion(t.fake_B_style, t.fake_B_style_)
+        t.g_loss = self.criterionGAN(t.DA_fake, tf.ones_like(t.DA_fake)) \
+            + self.criterionGAN(t.DB_fake, tf.ones_like(t.DB_fake)) \
+            + self.L1_lambda * abs_criterion(t.real_A, t.fake_A_) \
+            + self.L1_lambda * abs_criterion(t.real_B, t.fake_B_) \
+            + self.style_weight * abs_criterion(t.fake_B_style, t.fake_B_style_)
+
+        t.db_loss_real = self.criterionGAN(t.DB_real, tf.ones_like(t.DB_real))
+        t.db_loss_fake = self.criterionGAN(t.DB_fake_sample, tf.zeros_like(t.DB_fake_sample))
+        t.db_loss = (t.db_loss_real + t.db_loss_fake) / 2
+        t.da_loss_real = self.criterionGAN(t.DA_real, tf.ones_like(t.DA_real))
+        t.da_loss_fake = self.criterionGAN(t.DA_fake_sample, tf.zeros_like(t.DA_fake_sample))
+        t.da_loss = (t.da_loss_real + t.da_loss_fake) / 2
+        t.d_loss = t.da_loss + t.db_loss
+
+    def _build_towers(self, real_data):
+        """Split the batch across num_towers devices; model-level images and losses cover the whole batch."""
+        towers = []
+        for i, tower_data in enumerate(tf.split(real_data, self.num_towers, axis=0)):
+            with tf.device(self._tower_device(i)), tf.name_scope('tower_{0}'.format(i)):
+                t = Tower()
+                t.real_A = to_data_format(tower_data[:, :, :, :self.input_c_dim])
+                t.real_B = to_data_format(tower_data[:, :, :, self.input_c_dim: self.input_c_dim + self.output_c_dim])
+                self._build_generators(t, i > 0)
+                towers.append(t)
+        for name in ['real_A', 'real_B', 'fake_A', 'fake_B', 'fake_A_', 'fake_B_', 'fake_B_style', 'fake_B_style_']:
+            setattr(self, name, tf.concat([getattr(t, name) for t in towers], 0))
+
+        # the fakes go through one pool for the whole batch and are split back per tower
+        self._build_fake_samples()
+        fake_A_samples = tf.split(self.fake_A_sample, self.num_towers, axis=0)
+        fake_B_samples = tf.split(self.fake_B_sample, self.num_towers, axis=0)
+        for i, t in enumerate(towers):
+            with tf.device(self._tower_device(i)), tf.name_scope('tower_{0}'.format(i)):
+                t.fake_A_sample, t.fake_B_sample = fake_A_samples[i], fake_B_samples[i]
+                self._build_discriminators(t, i > 0)
+                self._build_losses(t)
+        for name in LOSS_NAMES:
+            setattr(self, name, tf.add_n([getattr(t, name) for t in towers]) / self.num_towers)
+        self.towers = towers
+
+    def _tower_device(self, i):
+        # variables stay on the host, so every tower reads and updates the same copy
+        def device(op):
+            if op.type in ('Variable', 'VariableV2', 'VarHandleOp'):
+                return '/cpu:0'
+            return self.tower_devices[i]
+        return device
+
+    def _compute_gradients(self, optimizer, loss, var_list):
+        """Gradients of the model loss named loss, averaged over the tower losses with several towers."""
+        if self.num_towers == 1:
+            return optimizer.compute_gradients(getattr(self, loss), var_list=var_list)
+        tower_grads = []
+        for i, t in enumerate(self.towers):
+            with tf.device(self._tower_device(i)), tf.name_scope('tower_{0}'.format(i)):
+                tower_grads.append(optimizer.compute_gradients(getattr(t, loss), var_list=var_list,
+                                                               colocate_gradients_with_ops=True))
+        grads = []
+        for grad_and_vars in zip(*tower_grads):
+            tower_values = [grad for grad, _ in grad_and_vars if grad is not None]
+            grad = tf.add_n(tower_values) / self.num_towers if tower_values else None
+            grads.append((grad, grad_and_vars[0][1]))
+        return grads
+
+    def _discriminate(self, images, reuse, name):
+        """One discriminator call on the concatenated images, with batch norm per input; split logits."""
+        splits = [tf.shape(image)[0] for image in images]
+        logits = self.discriminator(tf.concat(images, 0), self.options, reuse=reuse,
+                                    is_training=self.is_training, name=name, splits=splits)
+        return tf.split(logits, tf.stack(splits), num=len(images))
+
+    def _pooled_batch(self, images, name):
+        """Local variable holding the history buffer output for images, and the op that fills it."""
+        with tf.variable_scope(name):
+            batch = tf.get_variable('batch', [self.batch_size] + images.get_shape().as_list()[1:], tf.float32,
+                                    initializer=tf.zeros_initializer(), trainable=False,
+                                    collections=[tf.GraphKeys.LOCAL_VARIABLES])
+        store = tf.assign(batch, self._history_buffer(images, name))
+        return tf.identity(batch), store
+
+    def _history_buffer(self, images, name):
+        """In-graph utils.ImagePool over a local variable of max_size * batch_size images."""
+        if self.pool_capacity <= 0:
+            return images
+        with tf.variable_scope(name):
+            pool = tf.get_variable('images', [self.pool_capacity] + images.get_shape().as_list()[1:], tf.float32,
+                                   initializer=tf.zeros_initializer(), trainable=False,
+                                   collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            num_img = tf.get_variable('num_img', [], tf.int32, initializer=tf.zeros_initializer(), trainable=False,
+                                      collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            images = tf.stop_gradient(images)
+            n = tf.shape(images)[0]
+            position = num_img + tf.range(n)
+            filling = position < self.pool_capacity
+            swap = tf.logical_and(tf.logical_not(filling), tf.random_uniform([n]) > 0.5)
+            slot = tf.where(filling, position, tf.random_uniform([n], 0, self.pool_capacity, dtype=tf.int32))
+            out = tf.where(swap, tf.gather(pool, slot), images)
+            # same read-before-overwrite order as ImagePool._query
+            with tf.control_dependencies([out]):
+                stored = tf.logical_or(filling, swap)
+                update_pool = tf.scatter_update(pool, tf.boolean_mask(slot, stored), tf.boolean_mask(images, stored))
+                update_num_img = tf.assign(num_img, tf.minimum(num_img + n, self.pool_capacity))
+            with tf.control_dependencies([update_pool, update_num_img]):
+                return tf.identity(out)
+
+    def _build_train_ops(self, args):
+        self.lr = tf.placeholder(tf.float32, None, name='learning_rate')
+        g_optimizer = tf.train.AdamOptimizer(self.lr, beta1=args.beta1)
+        d_optimizer = tf.train.AdamOptimizer(self.lr, beta1=args.beta1)
+        g_grads = self._compute_gradients(g_optimizer, 'g_loss', self.g_vars)
+        d_grads = self._compute_gradients(d_optimizer, 'd_loss', self.d_vars)
+        if args.recompute:
+            missing = [var.op.name for grad, var in g_grads if grad is None]
+            if missing:
+                raise ValueError('--recompute leaves generator variables without a gradient: ' + ', '.join(missing))
+        if self.fused_step:
+            # both updates see the pre-step weights, like the G-then-D two-call loop
+            with tf.control_dependencies([grad for grad, _ in g_grads + d_grads if grad is not None]):
+                self.train_op = tf.group(g_optimizer.apply_gradients(g_grads),
+                                         d_optimizer.apply_gradients(d_grads))
+        else:
+            self.g_optim = g_optimizer.apply_gradients(g_grads)
+            self.d_optim = d_optimizer.apply_gradients(d_grads)
+
+    def _due_summaries(self, group, counter):
+        freq = self.summary_freq[group]
+        return self.writer is not None and freq > 0 and counter % freq == 0
+
+    def train_step(self, data_feed, lr, counter):
+        """Run one G and D update on the batch in data_feed (empty for the tf.data input)."""
+        g_summaries, d_summaries = [], []
+        if self._due_summaries('scalars', counter):
+            g_summaries.append(self.g_sum)
+            d_summaries.append(self.d_sum)
+        if self._due_summaries('images', counter):
+            g_summaries.append(self.image_sum)
+        if self._due_summaries('histograms', counter):
+            g_summaries.append(self.histogram_sum)
+
+        feed = {self.lr: lr, self.is_training: True}
+        feed.update(data_feed)
+        if self.fused_step:
+            summaries = self.sess.run([self.train_op] + g_summaries + d_summaries, feed_dict=feed)[1:]
+        elif self.pool_backend == 'graph':
+            # the pooled fakes stay in graph variables between the two calls
+            summaries = self.sess.run([self.store_fake_samples, self.g_optim] + g_summaries, feed_dict=feed)[2:]
+            summaries += self.sess.run([self.d_optim] + d_summaries, feed_dict=feed)[1:]
+        else:
+            # Update G network and record fake outputs
+            results = self.sess.run(
+                [self.fake_A, self.fake_B, self.g_optim] + g_summaries,
+                feed_dict=feed)
+            fake_A, fake_B, summaries = results[0], results[1], results[3:]
+            [fake_A, fake_B] = self.pool([fake_A, fake_B])
+
+            # Update D network
+            feed.update({self.fake_A_sample: fake_A, self.fake_B_sample: fake_B})
+            summaries += self.sess.run(
+                [self.d_optim] + d_summaries,
+                feed_dict=feed)[1:]
+        for summary_str in summaries:
+            self.summary_queue.submit(self.writer.add_summary, (summary_str, counter), 'summary')
+
+    def benchmark(self, args):
+        """Time training steps after warmup_steps on a random batch and return images/sec."""
+        self._build_train_ops(args)
+        self.writer = None
+        data_feed = {self.real_data: random_batch(args)}
+        mode = 'fused' if self.fused_step else 'two-call'
+        if args.recompute:
+            mode += ' recompute'
+
+        images_per_sec = self._time_train_steps(data_feed, args)
+        if not args.xla:
+            print(" [*] {0} step: {1:.4f} sec/step, {2:.1f} images/sec, peak memory {3:.0f} MB".format(
+                mode, self.batch_size / images_per_sec, images_per_sec, peak_memory_mb()))
+            return images_per_sec
+
+        xla_sess = self.sess
+        self.sess = tf.Session(config=session_config(xla=False, num_cpu_devices=num_cpu_devices(args)))
+        try:
+            reference = self._time_train_steps(data_feed, args)
+        finally:
+            self.sess.close()
+            self.sess = xla_sess
+        for name, value in [('no jit', reference), ('xla', images_per_sec)]:
+            print(" [*] {0} step, {1}: {2:.4f} sec/step, {3:.1f} images/sec".format(
+                mode, name, self.batch_size / value, value))
+        print(" [*] xla speedup: {0:.2f}x, peak memory {1:.0f} MB".format(images_per_sec / reference, peak_memory_mb()))
+        return images_per_sec
+
+    def autotune(self, args):
+        """Time a short training burst per thread setting and save the best for this host."""
+        self._build_train_ops(args)
+        self.writer = None
+        data_feed = {self.real_data: random_batch(args)}
+
+        num_cores = multiprocessing.cpu_count()
+        intra_ops = sorted(set([2 ** k for k in range(num_cores.bit_length()) if 2 ** k <= num_cores] + [num_cores]))
+        candidates = [(0, 0)] + [(intra_op, inter_op) for intra_op in intra_ops
+                                 for inter_op in [1, 2, 4] if inter_op <= num_cores]
+        main_sess = self.sess
+        best, best_images_per_sec = None, 0.
+        for threads in candidates:
+            self.sess = tf.Session(config=session_config(args.xla, threads, num_cpu_devices(args)))
+            try:
+                images_per_sec = self._time_train_steps(data_feed, args)
+            finally:
+                self.sess.close()
+                self.sess = main_sess
+            print(" [*] intra_op {0:3d} inter_op {1:2d}: {2:.1f} images/sec".format(
+                threads[0], threads[1], images_per_sec))
+            if images_per_sec > best_images_per_sec:
+                best, best_images_per_sec = threads, images_per_sec
+
+        save_thread_config(best[0], best[1], best_images_per_sec)
+        print(" [*] saved intra_op {0} inter_op {1} ({2:.1f} images/sec) to {3}".format(
+            best[0], best[1], best_images_per_sec, THREAD_CONFIG_PATH))
+        return best
+
+    def _time_train_steps(self, data_feed, args):
+        self.sess.run(tf.group(tf.global_variables_initializer(), tf.local_variables_initializer()))
+        for step in range(args.warmup_steps):
+            self.train_step(data_feed, args.lr, step)
+        start_time = time.time()
+        for step in range(args.benchmark_steps):
+            self.train_step(data_feed, args.lr, step)
+        step_time = (time.time() - start_time) / max(args.benchmark_steps, 1)
+        return self.batch_size / step_time
 
     def train(self, args):
         """Train cyclegan"""
-        self.lr = tf.placeholder(tf.float32, None, name='learning_rate')
-        self.g_optim = tf.train.AdamOptimizer(self.lr, beta1=args.beta1) \
-            .minimize(self.g_loss, var_list=self.g_vars)
-        self.d_optim = tf.train.AdamOptimizer(self.lr, beta1=args.beta1) \
-            .minimize(self.d_loss, var_list=self.d_vars)
+        self._build_train_ops(args)
+        self._build_checkpointing(args)
 
-        init_op = tf.global_variables_initializer()
+        init_op = tf.group(tf.global_variables_initializer(), tf.local_variables_initializer())
         self.sess.run(init_op)
 
         self.writer = tf.summary.FileWriter(args.log_dir, self.sess.graph)
+        # a single thread keeps events in step order
+        self.summary_queue = BackgroundWriter(1, args.writer_queue_size)
 
         counter = 1
+        start_epoch, start_idx, resume = 0, 0, None
         start_time = time.time()
 
         if args.continue_train:
             if self.load(args.checkpoint_dir):
                 print(" [*] Load SUCCESS")
+                resume = self.load_training_state(self.checkpoint_path)
             else:
                 print(" [!] Load failed...")
 
-        for epoch in range(args.epoch):
-            dataA = glob(self.dataset_dir + '/trainA/*/*.png')
-            dataB = glob(self.dataset_dir + '/trainB/*.png')
-            np.random.shuffle(dataA)
-            np.random.shuffle(dataB)
+        self.files = dict((split, load_manifest(self.dataset_dir, split, self.cache_dir)[0])
+                          for split in DATASET_SPLITS)
+        if self.use_cache:
+            build_dataset_cache(self.dataset_dir, self.cache_dir, args.fine_size)
+            self.cache = dict((split, load_dataset_cache(self.cache_dir, split, args.fine_size)[0])
+                              for split in DATASET_SPLITS)
+            cacheA, cacheB = self.cache['trainA'], self.cache['trainB']
+        self.load_sample_pool(args, resume['sample_idx'] if resume is not None else None)
+        if resume is not None:
+            counter, start_epoch, start_idx = resume['counter'], resume['epoch'], resume['idx']
+            np.random.set_state(resume['rng_state'])
+            print(" [*] Resuming at epoch {0}, batch {1}, step {2}".format(start_epoch, start_idx, counter))
+        first_counter = last_counter = counter
+        last_time = time.time()
+
+        for epoch in range(start_epoch, args.epoch):
+            if resume is not None and epoch == start_epoch:
+                # the interrupted epoch keeps its order and skips the batches it already trained on
+                permA, permB = resume['permA'], resume['permB']
+            else:
+                permA = np.random.permutation(len(self.files['trainA']))
+                permB = np.random.permutation(len(self.files['trainB']))
+            first_idx = start_idx if epoch == start_epoch else 0
+            # cache rows follow manifest order, so both loaders shuffle by index permutation
+            dataA, dataB = permA, permB
+            if not self.use_cache:
+                dataA = self.files['trainA'][dataA]
+                dataB = self.files['trainB'][dataB]
             batch_idxs = min(min(len(dataA), len(dataB)), args.train_size) // self.batch_size
             lr = args.lr if epoch < args.epoch_step else args.lr*(args.epoch-epoch)/(args.epoch-args.epoch_step)
 
-            for idx in range(0, batch_idxs):
-                batch_files = list(zip(dataA[idx * self.batch_size:(idx + 1) * self.batch_size],
-                                       dataB[idx * self.batch_size:(idx + 1) * self.batch_size]))
-                batch_images = [load_train_data(batch_file, args.load_size, args.fine_size) for batch_file in batch_files]
-                batch_images = np.array(batch_images).astype(np.float32)
-
-                # Update G network and record fake outputs
-                fake_A, fake_B, _, summary_str = self.sess.run(
-                    [self.fake_A, self.fake_B, self.g_optim, self.g_sum],
-                    feed_dict={self.real_data: batch_images, self.lr: lr, self.is_training:True})
-                self.writer.add_summary(summary_str, counter)
-                [fake_A, fake_B] = self.pool([fake_A, fake_B])
-
-                # Update D network
-                _, summary_str = self.sess.run(
-                    [self.d_optim, self.d_sum],
-                    feed_dict={self.real_data: batch_images,
-                               self.fake_A_sample: fake_A,
-                               self.fake_B_sample: fake_B,
-                               self.is_training: True,
-                               self.lr: lr})
-                self.writer.add_summary(summary_str, counter)
+            if self.input_mode == 'dataset':
+                self.sess.run(self.data_iterator.initializer,
+                              feed_dict={self.epoch_A: dataA[first_idx * self.batch_size:batch_idxs * self.batch_size],
+                                         self.epoch_B: dataB[first_idx * self.batch_size:batch_idxs * self.batch_size]})
+            else:
+                if self.use_cache:
+                    load_fn = load_cached_batch
+                    jobs = [(cacheA, cacheB,
+                             dataA[idx * self.batch_size:(idx + 1) * self.batch_size],
+                             dataB[idx * self.batch_size:(idx + 1) * self.batch_size],
+                             self.uint8_input) for idx in range(first_idx, batch_idxs)]
+                else:
+                    load_fn = load_train_batch
+                    jobs = [(list(zip(dataA[idx * self.batch_size:(idx + 1) * self.batch_size],
+                                      dataB[idx * self.batch_size:(idx + 1) * self.batch_size])),
+                             args.load_size, args.fine_size, False, self.uint8_input) for idx in range(first_idx, batch_idxs)]
+                # cached batches are plain slices, so only file decoding is worth a process pool
+                batches = BatchPrefetcher(load_fn, jobs, args.num_workers, args.prefetch_depth,
+                                          use_processes=args.prefetch_processes and not self.use_cache)
+            input_wait = 0.
+
+            for idx in range(first_idx, batch_idxs):
+                input_start = time.time()
+                if self.input_mode == 'dataset':
+                    if self.load_batch is not None:
+                        self.sess.run(self.load_batch)
+                    data_feed = {}
+                else:
+                    data_feed = {self.real_data: next(batches)}
+                input_wait += time.time() - input_start
+
+                self.train_step(data_feed, lr, counter)
 
                 counter += 1
+                if counter == first_counter + 1:
+                    # the first step pays for graph optimization and XLA compilation
+                    last_counter, last_time = counter, time.time()
 
                 if np.mod(counter, args.print_freq) == 1:
-                    print(("Epoch: [%2d] [%4d/%4d] time: %4.4f" % (
-                        epoch, idx, batch_idxs, time.time() - start_time)))
+                    now = time.time()
+                    print(("Epoch: [%2d] [%4d/%4d] time: %4.4f input wait: %4.4f images/sec: %4.1f" % (
+                        epoch, idx, batch_idxs, now - start_time, input_wait,
+                        (counter - last_counter) * self.batch_size / (now - last_time))))
                     self.sample_model(args.sample_dir, epoch, idx, args)
+                    last_counter, last_time = counter, time.time()
 
                 if np.mod(counter, args.save_freq) == 2:
-                    self.save(args.checkpoint_dir, counter)
+                    self.save(args.checkpoint_dir, counter,
+                              self._training_state(counter, epoch, idx + 1, permA, permB),
+                              self.checkpoint_metric() if self.keep_best_metric else None)
+
+            if self.input_mode != 'dataset':
+                batches.close()
+
+        self.image_writer.flush()
+        self.summary_queue.flush()
+        self.writer.flush()
+        if self.checkpoint_queue is not None:
+            self.checkpoint_queue.flush()
+
+    def _generator_variables(self, variables):
+        # generator weights and batch norm statistics, without optimizer slots
+        return [var for var in variables if 'generator' in var.op.name and 'Adam' not in var.op.name]
+
+    def _build_checkpointing(self, args):
+        """Savers of the training checkpoints, built once the optimizers exist."""
+        if self.keep_best_metric and self.keep_best_metric not in LOSS_NAMES:
+            raise ValueError('--keep_best_metric must be one of {0}, not {1}'.format(
+                ', '.join(LOSS_NAMES), self.keep_best_metric))
+        variables = tf.global_variables()
+        # max_to_keep=None everywhere: save applies the retention policy itself
+        self.saver = tf.train.Saver(var_list=variables, max_to_keep=None)
+        generator_variables = self._generator_variables(variables) if args.save_generator else []
+        if args.async_checkpoint:
+            with tf.variable_scope('checkpoint_shadow'):
+                shadows = [tf.get_variable(var.op.name, var.get_shape(), var.dtype.base_dtype,
+                                           initializer=tf.zeros_initializer(), trainable=False,
+                                           collections=[tf.GraphKeys.LOCAL_VARIABLES]) for var in variables]
+            self.snapshot_op = tf.group(*[tf.assign(shadow, var) for var, shadow in zip(variables, shadows)])
+            shadow_of = dict(zip(variables, shadows))
+            self.checkpoint_saver = tf.train.Saver(
+                var_list=dict((var.op.name, shadow_of[var]) for var in variables), max_to_keep=None)
+            self.generator_checkpoint_saver = tf.train.Saver(
+                var_list=dict((var.op.name, shadow_of[var]) for var in generator_variables),
+                max_to_keep=None) if generator_variables else None
+            # one writer keeps checkpoints in step order
+            self.checkpoint_queue = BackgroundWriter(1, 1)
+        else:
+            self.checkpoint_saver = self.saver
+            self.generator_checkpoint_saver = tf.train.Saver(
+                var_list=generator_variables, max_to_keep=None) if generator_variables else None
+        self.checkpoints, self.permanent_checkpoints, self.best_checkpoint = [], set(), None
+        self.last_permanent_step = None
+
+    def checkpoint_metric(self):
+        """Value of the --keep_best_metric loss on the first sample pool batch, in inference mode."""
+        feed = {self.real_data: self.sample_pool[:self.batch_size], self.is_training: False}
+        # the fakes are fed so that no image pool is touched
+        fake_A, fake_B = self.sess.run([self.fake_A, self.fake_B], feed_dict=feed)
+        feed.update({self.fake_A_sample: fake_A, self.fake_B_sample: fake_B})
+        return float(self.sess.run(getattr(self, self.keep_best_metric), feed_dict=feed))
+
+    def save(self, checkpoint_dir, step, state=None, metric=None):
+        """Write a checkpoint with its training state and apply retention, in the background with --async_checkpoint."""
+        if self.checkpoint_queue is not None:
+            self.checkpoint_queue.flush()
+        if state is not None:
+            path = os.path.join(checkpoint_dir, "cyclegan.model-{0}".format(step))
+            state = dict(state, **self._pool_state(path))
+        if self.checkpoint_queue is None:
+            self._write_checkpoint(checkpoint_dir, step, state, metric)
+            return
+        self.sess.run(self.snapshot_op)
+        self.checkpoint_queue.submit(self._write_checkpoint, (checkpoint_dir, step, state, metric),
+                                     'checkpoint {0}'.format(step))
 
-    def save(self, checkpoint_dir, step):
+    def _write_checkpoint(self, checkpoint_dir, step, state, metric):
         model_name = "cyclegan.model"
-        self.saver.save(self.sess,
-                        os.path.join(checkpoint_dir, model_name),
-                        global_step=step)
+        path = self.checkpoint_saver.save(self.sess,
+                                          os.path.join(checkpoint_dir, model_name),
+                                          global_step=step, write_state=False)
+        if state is not None:
+            # <checkpoint>.state.npz sits next to the variables and is dropped with them
+            np.savez_compressed(path + '.state.tmp.npz', **state)
+            os.rename(path + '.state.tmp.npz', path + '.state.npz')
+        if self.generator_checkpoint_saver is not None:
+            generator_dir = os.path.join(checkpoint_dir, 'generator')
+            if not os.path.exists(generator_dir):
+                os.makedirs(generator_dir)
+            self.generator_checkpoint_saver.save(self.sess, os.path.join(generator_dir, 'cyclegan.generator'),
+                                                 global_step=step, write_meta_graph=False, write_state=False)
+        self._apply_retention(checkpoint_dir, path, step, metric)
+
+    def _apply_retention(self, checkpoint_dir, path, step, metric):
+        """Keep the last keep_last checkpoints, one every keep_every steps and the lowest metric."""
+        self.checkpoints.append(path)
+        if self.keep_every > 0 and (self.last_permanent_step is None or
+                                    step // self.keep_every > self.last_permanent_step // self.keep_every):
+            self.permanent_checkpoints.add(path)
+            self.last_permanent_step = step
+        if metric is not None and (self.best_checkpoint is None or metric < self.best_checkpoint[1]):
+            self.best_checkpoint = (path, metric)
+        recent = self.checkpoints[-self.keep_last:] if self.keep_last > 0 else self.checkpoints
+        kept = [p for p in self.checkpoints if p in recent or p in self.permanent_checkpoints or
+                (self.best_checkpoint is not None and p == self.best_checkpoint[0])]
+        generator_dir = os.path.join(checkpoint_dir, 'generator')
+        for removed in set(self.checkpoints) - set(kept):
+            removed_step = removed.rsplit('-', 1)[-1]
+            for name in glob.glob(removed + '.*') + glob.glob(
+                    os.path.join(generator_dir, 'cyclegan.generator-{0}.*'.format(removed_step))):
+                os.remove(name)
+        self.checkpoints = kept
+        tf.train.update_checkpoint_state(checkpoint_dir, path, all_model_checkpoint_paths=kept)
+        if self.generator_checkpoint_saver is not None:
+            generator_paths = [os.path.join(generator_dir, 'cyclegan.generator-' + p.rsplit('-', 1)[-1]) for p in kept]
+            tf.train.update_checkpoint_state(generator_dir, generator_paths[-1],
+                                             all_model_checkpoint_paths=generator_paths)
 
     def load(self, checkpoint_dir):
         print(" [*] Reading checkpoint...")
         ckpt = tf.train.get_checkpoint_state(checkpoint_dir)
         if ckpt and ckpt.model_checkpoint_path:
             ckpt_name = os.path.basename(ckpt.model_checkpoint_path)
-            self.saver.restore(self.sess, os.path.join(checkpoint_dir, ckpt_name))
+            self.checkpoint_path = os.path.join(checkpoint_dir, ckpt_name)
+            try:
+                self.saver.restore(self.sess, self.checkpoint_path)
+            except tf.errors.NotFoundError:
+                # older checkpoints have no optimizer state, --save_generator copies only generators
+                saver = self.weights_saver
+                if not os.path.basename(ckpt_name).startswith("cyclegan.model"):
+                    saver = self.generator_saver
+                print(" [!] Not all variables are in {0}, restoring {1} only".format(
+                    ckpt_name, 'weights' if saver is self.weights_saver else 'generators'))
+                saver.restore(self.sess, self.checkpoint_path)
             return True
         else:
             return False
 
+    def _pool_variables(self):
+        # the in-graph history buffers are local variables, which the Saver leaves out
+        return [var for var in tf.local_variables() if '_pool/' in var.op.name]
+
+    def _training_state(self, counter, epoch, idx, permA, permB):
+        """What train needs besides the variables to continue exactly after this step."""
+        _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        return {'counter': counter, 'epoch': epoch, 'idx': idx, 'permA': permA, 'permB': permB,
+                'rng_keys': keys, 'rng_pos': pos, 'rng_has_gauss': has_gauss,
+                'rng_cached_gaussian': cached_gaussian,
+                'sample_idx_A': self.sample_idx[0], 'sample_idx_B': self.sample_idx[1]}
+
+    def _pool_state(self, path):
+        """Image pool contents for the checkpoint at path, the stored images in --pool_dtype."""
+        state = self.pool.state(path)
+        pool_variables = self._pool_variables()
+        for var, value in zip(pool_variables, self.sess.run(pool_variables)):
+            if var.op.name.endswith('/images'):
+                value = encode_images(value, self.pool.dtype)
+            state['graph/' + var.op.name] = value
+        return state
+
+    def load_training_state(self, checkpoint_path):
+        """Restore the image pools from <checkpoint>.state.npz and return the rest, or None without one."""
+        if not os.path.exists(checkpoint_path + '.state.npz'):
+            print(" [!] No training state for {0}, starting at epoch 0".format(os.path.basename(checkpoint_path)))
+            return None
+        # an NpzFile reads each array only when it is indexed
+        state = np.load(checkpoint_path + '.state.npz')
+        self.pool.restore(state, checkpoint_path)
+        for var in self._pool_variables():
+            if 'graph/' + var.op.name in state.files:
+                value = state['graph/' + var.op.name]
+                if var.op.name.endswith('/images'):
+                    value = decode_images(value)
+                var.load(value, self.sess)
+        resume = {'counter': int(state['counter']), 'epoch': int(state['epoch']), 'idx': int(state['idx']),
+                  'permA': state['permA'], 'permB': state['permB'],
+                  'rng_state': ('MT19937', state['rng_keys'], int(state['rng_pos']),
+                                int(state['rng_has_gauss']), float(state['rng_cached_gaussian'])),
+                  'sample_idx': None}
+        if 'sample_idx_A' in state.files:
+            resume['sample_idx'] = (state['sample_idx_A'], state['sample_idx_B'])
+        state.close()
+        return resume
+
+    def load_sample_pool(self, args, sample_idx=None):
+        """Decode the sample_model test images once; sample_idx keeps those of a resumed run."""
+        if sample_idx is None:
+            pool_size = max(args.sample_pool_size, self.batch_size)
+            idx_A = np.random.permutation(len(self.files['testA']))[:pool_size]
+            idx_B = np.random.permutation(len(self.files['testB']))[:pool_size]
+        else:
+            idx_A, idx_B = sample_idx
+        pool_size = min(len(idx_A), len(idx_B))
+        self.sample_idx = (idx_A[:pool_size], idx_B[:pool_size])
+        if self.use_cache:
+            self.sample_pool = load_cached_batch(self.cache['testA'], self.cache['testB'],
+                                                 idx_A[:pool_size], idx_B[:pool_size], self.uint8_input)
+        else:
+            batch_files = list(zip(self.files['testA'][idx_A[:pool_size]], self.files['testB'][idx_B[:pool_size]]))
+            self.sample_pool = load_train_batch(batch_files, load_size=args.load_size, fine_size=args.fine_size,
+                                                is_testing=True, as_uint8=self.uint8_input)
+
     def sample_model(self, sample_dir, epoch, idx, args):
-        dataA = glob(self.dataset_dir + '/testA/*/*.png')
-        dataB = glob(self.dataset_dir + '/testB/*.png')
-        np.random.shuffle(dataA)
-        np.random.shuffle(dataB)
-        batch_files = list(zip(dataA[:self.batch_size], dataB[:self.batch_size]))
-        sample_images = [load_train_data(batch_file, load_size=args.load_size, fine_size=args.fine_size, is_testing=True) for batch_file in batch_files]
-        sample_images = np.array(sample_images).astype(np.float32)
+        if args.fixed_sample:
+            sample_images = self.sample_pool[:self.batch_size]
+        else:
+            sample_images = self.sample_pool[np.random.permutation(len(self.sample_pool))[:self.batch_size]]
 
         real_A, fake_A, recon_A, real_B, fake_B, recon_B = self.sess.run(
-            [self.real_A, self.fake_A, self.fake_A_, self.real_B, self.fake_B, self.fake_B_],
+            self.sample_outputs,
             feed_dict={self.real_data: sample_images, self.is_training:False}
         )
         w = 16
         h = int(self.batch_size / w)
-        save_images(fake_A, [h, w],
-                    './{}/fakeA_{:02d}_{:04d}.jpg'.format(sample_dir, epoch, idx))
-        save_images(fake_B, [h, w],
-                    './{}/fakeB_{:02d}_{:04d}.jpg'.format(sample_dir, epoch, idx))
-        save_images(real_A, [h, w],
-                    './{}/realA_{:02d}_{:04d}.jpg'.format(sample_dir, epoch, idx))
-        save_images(real_B, [h, w],
-                    './{}/realB_{:02d}_{:04d}.jpg'.format(sample_dir, epoch, idx))
-        save_images(recon_A, [h, w],
-                    './{}/reconA_{:02d}_{:04d}.jpg'.format(sample_dir, epoch, idx))
-        save_images(recon_B, [h, w],
-                    './{}/reconB_{:02d}_{:04d}.jpg'.format(sample_dir, epoch, idx))
+        self.image_writer.save_grids([
+            (fake_A, [h, w], './{}/fakeA_{:02d}_{:04d}.jpg'.format(sample_dir, epoch, idx)),
+            (fake_B, [h, w], './{}/fakeB_{:02d}_{:04d}.jpg'.format(sample_dir, epoch, idx)),
+            (real_A, [h, w], './{}/realA_{:02d}_{:04d}.jpg'.format(sample_dir, epoch, idx)),
+            (real_B, [h, w], './{}/realB_{:02d}_{:04d}.jpg'.format(sample_dir, epoch, idx)),
+            (recon_A, [h, w], './{}/reconA_{:02d}_{:04d}.jpg'.format(sample_dir, epoch, idx)),
+            (recon_B, [h, w], './{}/reconB_{:02d}_{:04d}.jpg'.format(sample_dir, epoch, idx))])
     
 
 
@@ -264,9 +970,9 @@ class cyclegan(object):
         init_op = tf.global_variables_initializer()
         self.sess.run(init_op)
         if args.which_direction == 'AtoB':
-            sample_files = glob(self.dataset_dir + '/testA/*/*.png')
+            sample_files, sample_labels = load_manifest(self.dataset_dir, 'testA', self.cache_dir)
         elif args.which_direction == 'BtoA':
-            sample_files = glob(self.dataset_dir + '/testB/*.png')
+            sample_files, sample_labels = load_manifest(self.dataset_dir, 'testB', self.cache_dir)
         else:
             raise Exception('--which_direction must be AtoB or BtoA')
 
@@ -275,38 +981,74 @@ class cyclegan(object):
         else:
             print(" [!] Load failed...")
 
-        # write html for visual comparison
-        index_path = os.path.join(args.test_dir, '{0}_index.html'.format(args.which_direction))
-        index = open(index_path, "w")
-        index.write("<html><body><table><tr>")
-        index.write("<th>name</th><th>input</th><th>output</th></tr>")
+        if args.test_output == 'shards':
+            # translated images go to uint8 shards readable by load_image_shards, no pngs or html
+            if args.shard_label_file:
+                sample_labels = mat_labels(args.shard_label_file, sample_files)
+            if np.any(np.asarray(sample_labels) < 0):
+                # flat input folders have no class subfolders to take labels from
+                raise ValueError('{0} has unlabeled images, pass --shard_label_file for --test_output shards'.format(
+                    'testA' if args.which_direction == 'AtoB' else 'testB'))
+            shards = ImageShardWriter(os.path.join(args.test_dir, args.which_direction),
+                                      args.shard_size, self.image_writer)
+        else:
+            shards = None
+            # write html for visual comparison
+            index_path = os.path.join(args.test_dir, '{0}_index.html'.format(args.which_direction))
+            index = open(index_path, "w")
+            index.write("<html><body><table><tr>")
+            index.write("<th>name</th><th>input</th><th>output</th></tr>")
 
         out_var, in_var = (self.testB, self.test_A) if args.which_direction == 'AtoB' else (
             self.testA, self.test_B)
 
-        for sample_file in sample_files:
-            print('Processing image: ' + sample_file)
-            sample_image = [load_test_data(image_path=sample_file, is_gray_scale=(args.which_direction == 'AtoB'), fine_size=args.fine_size)]
-            sample_image = np.array(sample_image).astype(np.float32)
-            if len(sample_image.shape) is 3:
-                sample_image = np.expand_dims(sample_image, axis = 3)
-            if args.which_direction == 'AtoB':
-                subfolder_name = os.path.split(os.path.dirname(sample_file))[-1]
-                image_folder_path = os.path.join(args.test_dir, subfolder_name)
-                if not os.path.exists(image_folder_path):
-                    os.mkdir(image_folder_path)
-                image_path = os.path.join(image_folder_path,
-                                      '{0}'.format(os.path.basename(sample_file)))
-            else:
-                image_path = os.path.join(args.test_dir,
+        # decode upcoming batches in the prefetcher while the current one runs through the session
+        test_batch_size = max(args.test_batch_size, 1)
+        is_gray_scale = (args.which_direction == 'AtoB')
+        batch_files = [sample_files[i:i + test_batch_size] for i in range(0, len(sample_files), test_batch_size)]
+        batches = BatchPrefetcher(load_test_batch, [(files, is_gray_scale, args.fine_size) for files in batch_files],
+                                  args.num_workers, args.prefetch_depth, use_processes=args.prefetch_processes)
+
+        num_timed, timed = 0, 0.
+        for batch_idx, files in enumerate(batch_files):
+            print('Processing images: {0} - {1}'.format(files[0], files[-1]))
+            sample_images = next(batches)
+            run_start = time.time()
+            fake_imgs = self.sess.run(out_var, feed_dict={in_var: sample_images, self.is_training:False})
+            if batch_idx > 0:
+                # the first batch is the warm-up that compiles the graph
+                num_timed, timed = num_timed + len(files), timed + time.time() - run_start
+            if shards is not None:
+                names = [os.path.join(os.path.split(os.path.dirname(f))[-1], os.path.basename(f))
+                         if args.which_direction == 'AtoB' else os.path.basename(f) for f in files]
+                shards.add(fake_imgs, names,
+                           sample_labels[batch_idx * test_batch_size:batch_idx * test_batch_size + len(files)])
+                continue
+            for sample_file, fake_img in zip(files, fake_imgs):
+                if args.which_direction == 'AtoB':
+                    subfolder_name = os.path.split(os.path.dirname(sample_file))[-1]
+                    image_folder_path = os.path.join(args.test_dir, subfolder_name)
+                    if not os.path.exists(image_folder_path):
+                        os.mkdir(image_folder_path)
+                    image_path = os.path.join(image_folder_path,
                                           '{0}'.format(os.path.basename(sample_file)))
-            fake_img = self.sess.run(out_var, feed_dict={in_var: sample_image, self.is_training:False})
-            save_images(fake_img, [1, 1], image_path)
-            index.write("<td>%s</td>" % os.path.basename(image_path))
-            index.write("<td><img src='%s'></td>" % (sample_file if os.path.isabs(sample_file) else (
-                '..' + os.path.sep + sample_file)))
-            index.write("<td><img src='%s'></td>" % (image_path if os.path.isabs(image_path) else (
-                '..' + os.path.sep + image_path)))
-            index.write("</tr>")
-        index.close()
+                else:
+                    image_path = os.path.join(args.test_dir,
+                                              '{0}'.format(os.path.basename(sample_file)))
+                self.image_writer.save(fake_img[np.newaxis], [1, 1], image_path)
+                index.write("<td>%s</td>" % os.path.basename(image_path))
+                index.write("<td><img src='%s'></td>" % (sample_file if os.path.isabs(sample_file) else (
+                    '..' + os.path.sep + sample_file)))
+                index.write("<td><img src='%s'></td>" % (image_path if os.path.isabs(image_path) else (
+                    '..' + os.path.sep + image_path)))
+                index.write("</tr>")
+        batches.close()
+        if num_timed:
+            print(" [*] translated {0} images at {1:.1f} images/sec (first batch excluded)".format(
+                num_timed, num_timed / timed))
+        if shards is not None:
+            shards.close()
+        else:
+            index.close()
+        self.image_writer.flush()
 
@@ -4,7 +4,8 @@ from ops import *
 from utils import *
 
 
-def discriminator(image, options, reuse=False, is_training=True, name="discriminator"):
+def discriminator(image, options, reuse=False, is_training=True, name="discriminator", splits=None):
+    # splits: batch sizes of inputs concatenated into image, see ops.batch_norm
 
     with tf.variable_scope(name):
         # image is 256 x 256 x input_c_dim
@@ -26,8 +27,8 @@ def discriminator(image, options, reuse=False, is_training=True, name="discrimin
     # return h4
 
         h0 = lrelu(conv2d(image, options.df_dim, name='d_h0_conv'), leak=0.05)
-        h1 = lrelu(batch_norm(conv2d(h0, options.df_dim*2, name='d_h1_conv'), is_training, 'd_bn1'), leak=0.05)
-        h2 = lrelu(batch_norm(conv2d(h1, options.df_dim*4, name='d_h2_conv'), is_training, 'd_bn2'), leak=0.05)
+        h1 = lrelu(batch_norm(conv2d(h0, options.df_dim*2, name='d_h1_conv'), is_training, 'd_bn1', splits), leak=0.05)
+        h2 = lrelu(batch_norm(conv2d(h1, options.df_dim*4, name='d_h2_conv'), is_training, 'd_bn2', splits), leak=0.05)
         h3 = conv2d(h2, 1, 4, s=1, padding='VALID', name='d_h3_pred')
     return h3
 
@@ -65,33 +66,33 @@ def generator_unet(image, options, reuse=False, name="generator"):
 
         d1 = deconv2d(tf.nn.relu(e8), options.gf_dim*8, name='g_d1')
         d1 = tf.nn.dropout(d1, dropout_rate)
-        d1 = tf.concat([instance_norm(d1, 'g_bn_d1'), e7], 3)
+        d1 = tf.concat([instance_norm(d1, 'g_bn_d1'), e7], channel_axis())
         # d1 is (2 x 2 x self.gf_dim*8*2)
 
         d2 = deconv2d(tf.nn.relu(d1), options.gf_dim*8, name='g_d2')
         d2 = tf.nn.dropout(d2, dropout_rate)
-        d2 = tf.concat([instance_norm(d2, 'g_bn_d2'), e6], 3)
+        d2 = tf.concat([instance_norm(d2, 'g_bn_d2'), e6], channel_axis())
         # d2 is (4 x 4 x self.gf_dim*8*2)
 
         d3 = deconv2d(tf.nn.relu(d2), options.gf_dim*8, name='g_d3')
         d3 = tf.nn.dropout(d3, dropout_rate)
-        d3 = tf.concat([instance_norm(d3, 'g_bn_d3'), e5], 3)
+        d3 = tf.concat([instance_norm(d3, 'g_bn_d3'), e5], channel_axis())
         # d3 is (8 x 8 x self.gf_dim*8*2)
 
         d4 = deconv2d(tf.nn.relu(d3), options.gf_dim*8, name='g_d4')
-        d4 = tf.concat([instance_norm(d4, 'g_bn_d4'), e4], 3)
+        d4 = tf.concat([instance_norm(d4, 'g_bn_d4'), e4], channel_axis())
         # d4 is (16 x 16 x self.gf_dim*8*2)
 
         d5 = deconv2d(tf.nn.relu(d4), options.gf_dim*4, name='g_d5')
-        d5 = tf.concat([instance_norm(d5, 'g_bn_d5'), e3], 3)
+        d5 = tf.concat([instance_norm(d5, 'g_bn_d5'), e3], channel_axis())
         # d5 is (32 x 32 x self.gf_dim*4*2)
 
         d6 = deconv2d(tf.nn.relu(d5), options.gf_dim*2, name='g_d6')
-        d6 = tf.concat([instance_norm(d6, 'g_bn_d6'), e2], 3)
+        d6 = tf.concat([instance_norm(d6, 'g_bn_d6'), e2], channel_axis())
         # d6 is (64 x 64 x self.gf_dim*2*2)
 
         d7 = deconv2d(tf.nn.relu(d6), options.gf_dim, name='g_d7')
-        d7 = tf.concat([instance_norm(d7, 'g_bn_d7'), e1], 3)
+        d7 = tf.concat([instance_norm(d7, 'g_bn_d7'), e1], channel_axis())
         # d7 is (128 x 128 x self.gf_dim*1*2)
 
         d8 = deconv2d(tf.nn.relu(d7), options.output_c_dim, name='g_d8')
@@ -159,90 +160,77 @@ def generator_resnet(image, options, reuse=False, is_training=True, name="genera
 # SVHN -> MNIST 
 def generator_B2A(image, options, reuse=False, is_training=True, name="generator"):
 
-    with tf.variable_scope(name):
+    # recompute_grad only tracks resource variables, see ops.recomputable
+    with tf.variable_scope(name, use_resource=options.recompute or None):
         # image is 256 x 256 x input_c_dim
         if reuse:
             tf.get_variable_scope().reuse_variables()
         else:
             assert tf.get_variable_scope().reuse is False
 
-        if options.use_bn:
-            # shared layers: conv + conv + conv 
-            c1 = lrelu(batch_norm(conv2d(image, options.gf_dim, 4, 2, name='g_e1_c'), is_training, 'g_e1_bn'), leak=0.05)
-            c2 = lrelu(batch_norm(conv2d(c1, options.gf_dim*2, 4, 2, name='g_e2_c'), is_training, 'g_e2_bn'), leak=0.05)
-            c3 = lrelu(batch_norm(conv2d(c2, options.gf_dim*2, 3, 1, name='g_e3_c'), is_training, 'g_e3_bn'), leak=0.05)
-
-            # class: conv + deconv + deconv
-            c4_class = lrelu(batch_norm(conv2d(c3, options.gf_dim*2, 3, 1, name='g_e4_class_c'), is_training, 'g_e4_class_bn'), leak=0.05)
-            d1_class = lrelu(batch_norm(deconv2d(c4_class, options.gf_dim, 4, 2, name='g_d1_class_dc'),is_training, 'g_d1_class_bn'), leak=0.05)
-            pred_class =  tf.nn.tanh(deconv2d(d1_class, options.input_c_dim, 4, 2, name='g_pred_class_dc'))
+        def norm(x, name, is_recomputing):
+            if options.use_bn:
+                return batch_norm(x, is_training, name, update_stats=not is_recomputing)
+            return instance_norm(x, name)
 
-            # style: conv + fc
-            pred_style = tf.layers.dense(tf.contrib.layers.flatten(c3), options.output_style_dim, name='g_pred_style_fc')
-            return pred_class, pred_style
-        else:
+        def encoder(image, is_recomputing=False):
             # shared layers: conv + conv + conv 
-            c1 = lrelu(instance_norm(conv2d(image, options.gf_dim, 4, 2, name='g_e1_c'), is_training, 'g_e1_bn'), leak=0.05)
-            c2 = lrelu(instance_norm(conv2d(c1, options.gf_dim*2, 4, 2, name='g_e2_c'), is_training, 'g_e2_bn'), leak=0.05)
-            c3 = lrelu(instance_norm(conv2d(c2, options.gf_dim*2, 3, 1, name='g_e3_c'), is_training, 'g_e3_bn'), leak=0.05)
+            c1 = lrelu(norm(conv2d(image, options.gf_dim, 4, 2, name='g_e1_c'), 'g_e1_bn', is_recomputing), leak=0.05)
+            c2 = lrelu(norm(conv2d(c1, options.gf_dim*2, 4, 2, name='g_e2_c'), 'g_e2_bn', is_recomputing), leak=0.05)
+            return lrelu(norm(conv2d(c2, options.gf_dim*2, 3, 1, name='g_e3_c'), 'g_e3_bn', is_recomputing), leak=0.05)
 
+        def class_decoder(c3, is_recomputing=False):
             # class: conv + deconv + deconv
-            c4_class = lrelu(instance_norm(conv2d(c3, options.gf_dim*2, 3, 1, name='g_e4_class_c'), is_training, 'g_e4_class_bn'), leak=0.05)
-            d1_class = lrelu(instance_norm(deconv2d(c4_class, options.gf_dim, 4, 2, name='g_d1_class_dc'),is_training, 'g_d1_class_bn'), leak=0.05)
-            pred_class =  tf.nn.tanh(deconv2d(d1_class, options.input_c_dim, 4, 2, name='g_pred_class_dc'))
+            c4_class = lrelu(norm(conv2d(c3, options.gf_dim*2, 3, 1, name='g_e4_class_c'), 'g_e4_class_bn', is_recomputing), leak=0.05)
+            d1_class = lrelu(norm(deconv2d(c4_class, options.gf_dim, 4, 2, name='g_d1_class_dc'), 'g_d1_class_bn', is_recomputing), leak=0.05)
+            return tf.nn.tanh(deconv2d(d1_class, options.input_c_dim, 4, 2, name='g_pred_class_dc'))
+
+        c3 = recomputable(encoder, options.recompute)(image)
+        pred_class = recomputable(class_decoder, options.recompute)(c3)
 
-            # style: conv + fc
-            pred_style = tf.layers.dense(tf.contrib.layers.flatten(c3), options.output_style_dim, name='g_pred_style_fc')
-            return pred_class, pred_style
+        # style: conv + fc
+        # flattened in NHWC order so the dense weights do not depend on the layout
+        pred_style = tf.layers.dense(tf.contrib.layers.flatten(from_data_format(c3)), options.output_style_dim, name='g_pred_style_fc')
+        return pred_class, pred_style
 
 
 # MNIST -> SVHN 
-def generator_A2B(image, style, options, reuse=False, is_training=True, name="generator"):
+def generator_A2B(image, style, options, reuse=False, is_training=True, name="generator", splits=None):
+    # splits: batch sizes of inputs concatenated into image and style, see ops.batch_norm
 
-    with tf.variable_scope(name):
+    with tf.variable_scope(name, use_resource=options.recompute or None):
         if reuse:
             tf.get_variable_scope().reuse_variables()
         else:
             assert tf.get_variable_scope().reuse is False
 
+        def norm(x, name, is_recomputing):
+            if options.use_bn:
+                return batch_norm(x, is_training, name, splits, update_stats=not is_recomputing)
+            return instance_norm(x, name)
 
-        # class: conv + conv + conv
-        if options.use_bn:
-            c1_class = lrelu(batch_norm(conv2d(image, options.gf_dim, 4, 2, name='g_e1_class_c'), is_training, 'g_e1_class_bn'), leak=0.05)
-            c2_class = lrelu(batch_norm(conv2d(c1_class, options.gf_dim*2, 4, 2, name='g_e2_class_c'), is_training, 'g_e2_class_bn'), leak=0.05)
-            c3_class = lrelu(batch_norm(conv2d(c2_class, options.gf_dim*2, 3, 1, name='g_e3_class_c'), is_training, 'g_e3_class_bn'), leak=0.05)
-
-            # style: fc + reshape 
-            fc_style = tf.layers.dense(tf.contrib.layers.flatten(style), c3_class.get_shape()[1]*c3_class.get_shape()[2]*c3_class.get_shape()[3], name='g_e1_style_fc')
-            fc_style = tf.reshape(fc_style, [-1, int(c3_class.get_shape()[1]), int(c3_class.get_shape()[2]),int(c3_class.get_shape()[3])])
-            
-            #concat class info and style info
-            c3 = tf.concat([c3_class, fc_style], axis = 3)
-
-            # shared layers: conv + deconv + deconv 
-            c4 = lrelu(batch_norm(conv2d(c3, options.gf_dim*2, 3, 1, name='g_e4_c'), is_training, 'g_e4_bn'), leak=0.05)
-            d1 = lrelu(batch_norm(deconv2d(c4, options.gf_dim, 4, 2, name='g_d1_dc'),is_training, 'g_d1_bn'), leak=0.05)
-            pred = tf.nn.tanh(deconv2d(d1, options.output_c_dim, 4, 2, name='g_pred_dc'))
-
-            return pred
-        else:
-            c1_class = lrelu(instance_norm(conv2d(image, options.gf_dim, 4, 2, name='g_e1_class_c'), is_training, 'g_e1_class_bn'), leak=0.05)
-            c2_class = lrelu(instance_norm(conv2d(c1_class, options.gf_dim*2, 4, 2, name='g_e2_class_c'), is_training, 'g_e2_class_bn'), leak=0.05)
-            c3_class = lrelu(instance_norm(conv2d(c2_class, options.gf_dim*2, 3, 1, name='g_e3_class_c'), is_training, 'g_e3_class_bn'), leak=0.05)
+        def class_encoder(image, is_recomputing=False):
+            # class: conv + conv + conv
+            c1_class = lrelu(norm(conv2d(image, options.gf_dim, 4, 2, name='g_e1_class_c'), 'g_e1_class_bn', is_recomputing), leak=0.05)
+            c2_class = lrelu(norm(conv2d(c1_class, options.gf_dim*2, 4, 2, name='g_e2_class_c'), 'g_e2_class_bn', is_recomputing), leak=0.05)
+            return lrelu(norm(conv2d(c2_class, options.gf_dim*2, 3, 1, name='g_e3_class_c'), 'g_e3_class_bn', is_recomputing), leak=0.05)
 
+        def decoder(c3_class, style, is_recomputing=False):
             # style: fc + reshape 
-            fc_style = tf.layers.dense(tf.contrib.layers.flatten(style), c3_class.get_shape()[1]*c3_class.get_shape()[2]*c3_class.get_shape()[3], name='g_e1_style_fc')
-            fc_style = tf.reshape(fc_style, [-1, int(c3_class.get_shape()[1]), int(c3_class.get_shape()[2]),int(c3_class.get_shape()[3])])
+            h, w, c = image_dims(c3_class)
+            fc_style = tf.layers.dense(tf.contrib.layers.flatten(style), h*w*c, name='g_e1_style_fc')
+            fc_style = to_data_format(tf.reshape(fc_style, [-1, h, w, c]))
             
             #concat class info and style info
-            c3 = tf.concat([c3_class, fc_style], axis = 3)
+            c3 = tf.concat([c3_class, fc_style], axis = channel_axis())
 
             # shared layers: conv + deconv + deconv 
-            c4 = lrelu(instance_norm(conv2d(c3, options.gf_dim*2, 3, 1, name='g_e4_c'), is_training, 'g_e4_bn'), leak=0.05)
-            d1 = lrelu(instance_norm(deconv2d(c4, options.gf_dim, 4, 2, name='g_d1_dc'),is_training, 'g_d1_bn'), leak=0.05)
-            pred = tf.nn.tanh(deconv2d(d1, options.output_c_dim, 4, 2, name='g_pred_dc'))
+            c4 = lrelu(norm(conv2d(c3, options.gf_dim*2, 3, 1, name='g_e4_c'), 'g_e4_bn', is_recomputing), leak=0.05)
+            d1 = lrelu(norm(deconv2d(c4, options.gf_dim, 4, 2, name='g_d1_dc'), 'g_d1_bn', is_recomputing), leak=0.05)
+            return tf.nn.tanh(deconv2d(d1, options.output_c_dim, 4, 2, name='g_pred_dc'))
 
-            return pred
+        c3_class = recomputable(class_encoder, options.recompute)(image)
+        return recomputable(decoder, options.recompute)(c3_class, style)
 
 
 
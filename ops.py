@@ -6,29 +6,101 @@ from tensorflow.python.framework import ops
 
 from utils import *
 
-def batch_norm(x, is_training=True, name="batch_norm"):
-    return tf.contrib.layers.batch_norm(x, decay=0.9, updates_collections=None, is_training=is_training, epsilon=1e-5, scale=True, scope=name)
+# layout of the image tensors inside the networks, set once before the graph is
+# built; the model converts its inputs and outputs, which are always NHWC
+DATA_FORMAT = 'NHWC'
 
-def instance_norm(input, name="instance_norm"):
+def set_data_format(data_format):
+    global DATA_FORMAT
+    if data_format not in ('NHWC', 'NCHW'):
+        raise ValueError('data_format must be NHWC or NCHW, got {0}'.format(data_format))
+    DATA_FORMAT = data_format
+
+def channel_axis():
+    return 1 if DATA_FORMAT == 'NCHW' else 3
+
+def layout_dims(h, w, c):
+    # per-image shape [h, w, c] in the current layout
+    return [c, h, w] if DATA_FORMAT == 'NCHW' else [h, w, c]
+
+def image_dims(x):
+    # static (h, w, c) of an image tensor in the current layout
+    dims = [int(d) for d in x.get_shape()[1:]]
+    return (dims[1], dims[2], dims[0]) if DATA_FORMAT == 'NCHW' else tuple(dims)
+
+def to_data_format(x):
+    return tf.transpose(x, [0, 3, 1, 2]) if DATA_FORMAT == 'NCHW' else x
+
+def from_data_format(x):
+    return tf.transpose(x, [0, 2, 3, 1]) if DATA_FORMAT == 'NCHW' else x
+
+# moving average updates of recomputed forward passes go here and are never run
+SKIPPED_BN_UPDATES = 'skipped_batch_norm_updates'
+
+def batch_norm(x, is_training=True, name="batch_norm", splits=None, update_stats=True):
+    # splits: sizes of consecutive groups along the batch axis that are normalized
+    # separately (with shared variables), as if each group had its own call
+    # update_stats=False normalizes the same way but leaves the moving averages alone
+    updates_collections = None if update_stats else SKIPPED_BN_UPDATES
+    if splits is None:
+        return tf.contrib.layers.batch_norm(x, decay=0.9, updates_collections=updates_collections, is_training=is_training, epsilon=1e-5, scale=True,
+                                            data_format=DATA_FORMAT, scope=name)
+    outputs = []
+    for i, part in enumerate(tf.split(x, tf.stack(splits), num=len(splits))):
+        outputs.append(tf.contrib.layers.batch_norm(part, decay=0.9, updates_collections=updates_collections, is_training=is_training, epsilon=1e-5, scale=True,
+                                                    data_format=DATA_FORMAT, reuse=True if i > 0 else None, scope=name))
+    return tf.concat(outputs, 0)
+
+def recomputable(fn, recompute=False):
+    # with recompute, the activations inside fn are dropped after the forward pass and
+    # recomputed from its inputs during backprop; fn(..., is_recomputing=True) is the
+    # recomputation, which must not update batch norm moving averages a second time
+    # the variables fn creates must be ResourceVariables (variable_scope(use_resource=True)):
+    # recompute_grad raises on ref variables when building fn and gives them no gradient on reuse
+    return tf.contrib.layers.recompute_grad(fn) if recompute else fn
+
+def instance_norm(input, name="instance_norm", fused=True):
+    # fused: normalize with one fused batch norm op, treating every (image, channel)
+    # pair as a channel of a single-image batch; same variables and result as the
+    # moments-based reference computation (fused=False)
     with tf.variable_scope(name):
-        depth = input.get_shape()[3]
+        depth = input.get_shape()[channel_axis()]
         scale = tf.get_variable("scale", [depth], initializer=tf.random_normal_initializer(1.0, 0.02, dtype=tf.float32))
         offset = tf.get_variable("offset", [depth], initializer=tf.constant_initializer(0.0))
-        mean, variance = tf.nn.moments(input, axes=[1,2], keep_dims=True)
         epsilon = 1e-5
+        if fused:
+            shape = tf.shape(input)
+            batch = shape[0]
+            if DATA_FORMAT == 'NCHW':
+                # [N, C, H, W] -> [1, N*C, H, W] is a plain reshape
+                x = tf.reshape(input, tf.stack([1, -1, shape[2], shape[3]]))
+            else:
+                # [N, H, W, C] -> [1, H, W, N*C]
+                x = tf.reshape(tf.transpose(input, [1, 2, 0, 3]), tf.stack([1, shape[1], shape[2], -1]))
+            y, _, _ = tf.nn.fused_batch_norm(x, tf.tile(scale, [batch]), tf.tile(offset, [batch]),
+                                             epsilon=epsilon, data_format=DATA_FORMAT, is_training=True)
+            if DATA_FORMAT == 'NCHW':
+                y = tf.reshape(y, shape)
+            else:
+                y = tf.transpose(tf.reshape(y, tf.stack([shape[1], shape[2], batch, shape[3]])), [2, 0, 1, 3])
+            y.set_shape(input.get_shape())
+            return y
+        if DATA_FORMAT == 'NCHW':
+            scale, offset = tf.reshape(scale, [-1, 1, 1]), tf.reshape(offset, [-1, 1, 1])
+        mean, variance = tf.nn.moments(input, axes=[2,3] if DATA_FORMAT == 'NCHW' else [1,2], keep_dims=True)
         inv = tf.rsqrt(variance + epsilon)
         normalized = (input-mean)*inv
         return scale*normalized + offset
 
 def conv2d(input_, output_dim, ks=4, s=2, stddev=0.02, padding='SAME', name="conv2d"):
     with tf.variable_scope(name):
-        return slim.conv2d(input_, output_dim, ks, s, padding=padding, activation_fn=None,
+        return slim.conv2d(input_, output_dim, ks, s, padding=padding, activation_fn=None, data_format=DATA_FORMAT,
                             weights_initializer=tf.truncated_normal_initializer(stddev=stddev),
                             biases_initializer=None)
 
 def deconv2d(input_, output_dim, ks=4, s=2, stddev=0.02, name="deconv2d"):
     with tf.variable_scope(name):
-        return slim.conv2d_transpose(input_, output_dim, ks, s, padding='SAME', activation_fn=None,
+        return slim.conv2d_transpose(input_, output_dim, ks, s, padding='SAME', activation_fn=None, data_format=DATA_FORMAT,
                                     weights_initializer=tf.truncated_normal_initializer(stddev=stddev),
                                     biases_initializer=None)
 
@@ -40,6 +40,7 @@ import tensorflow as tf
 import tensorflow.contrib.slim as slim
 from tensorflow.python.platform import app
 from tensorflow.python.platform import flags
+from tools.thread_config import apply_thread_config
 
 
 # python semisup/eval.py \
@@ -208,6 +209,7 @@ def main(_):
         extra_in_final_batch = (num_batches*FLAGS.eval_batch_size)-len(test_labels)
 
         config = tf.ConfigProto()
+        apply_thread_config(config)
         config.gpu_options.allow_growth = True
         sess = tf.Session(config=config)
         # sess.run(tf.initialize_local_variables())
@@ -5,6 +5,7 @@ import os
 import numpy as np
 import inspect
 import tensorflow as tf
+from tools.thread_config import apply_thread_config
 
 
 def train(graph, logdir,
@@ -46,6 +47,7 @@ def train(graph, logdir,
     sess_config = tf.ConfigProto()
     sess_config.gpu_options.allow_growth = True
     sess_config.allow_soft_placement=True
+    apply_thread_config(sess_config)
   sess = tf.Session(graph=graph, config=sess_config)
 
   # Init all variables
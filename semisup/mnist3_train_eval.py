@@ -63,6 +63,7 @@ flags.DEFINE_string('logdir', '/tmp/semisup_mnist', 'Training log path.')
 
 from tools import mnist3 as mnist_tools
 from tools import svhn as svhn_tools
+from tools.thread_config import apply_thread_config
 from functools import partial
 NUM_LABELS = mnist_tools.NUM_LABELS
 IMAGE_SHAPE = mnist_tools.IMAGE_SHAPE
@@ -118,7 +119,7 @@ def main(_):
 
     saver = tf.train.Saver()
 
-  with tf.Session(graph=graph) as sess:
+  with tf.Session(graph=graph, config=apply_thread_config(tf.ConfigProto())) as sess:
     tf.global_variables_initializer().run()
 
     coord = tf.train.Coordinator()
@@ -0,0 +1,25 @@
+"""
+Reader for translated images exported by the cyclegan test phase with
+--test_output shards: uint8 <prefix>_shard_<k>.npy arrays listed, together with
+the source filename and label of every image, in <prefix>_shards.npz.
+"""
+from __future__ import division
+from __future__ import print_function
+import os
+import numpy as np
+
+
+def read_image_shards(index_path):
+  """Read a shard export.
+
+  Args:
+   index_path: path of the <prefix>_shards.npz index
+
+  Returns:
+   uint8 images [N, h, w, c], filenames, labels
+  """
+  index = np.load(index_path)
+  shard_dir = os.path.dirname(index_path)
+  images = np.concatenate([np.load(os.path.join(shard_dir, shard))
+                           for shard in index['shards']])
+  return images, index['filenames'], index['labels']
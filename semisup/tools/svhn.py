@@ -22,9 +22,11 @@ They are used in svhn_train.py and svhn_eval.py.
 """
 from __future__ import division
 from __future__ import print_function
+import os
 import numpy as np
 import scipy.io
 import data_dirs
+import image_shards
 
 
 DATADIR = data_dirs.svhn
@@ -47,6 +49,14 @@ def get_data(name):
     print("load train")
   elif name == 'test':
     data = scipy.io.loadmat(DATADIR + 'test_32x32.mat')
+  elif os.path.exists(DATADIR + '%s_shards.npz'%name):
+    # translated images exported by the cyclegan test phase, no png/.mat round trip
+    images, _, labels = image_shards.read_image_shards(DATADIR + '%s_shards.npz'%name)
+    if np.any(labels < 0):
+      raise ValueError('%s_shards.npz has unlabeled images, export it with --shard_label_file' % name)
+    if images.shape[-1] == 1:
+      images = np.repeat(images, 3, axis=3)
+    return images, labels % 10
   else:
   # elif name == 'cycle_nolabel' or name == 'cycle_singlelabel':
     data = scipy.io.loadmat(DATADIR + '%s_32x32.mat'%name)
@@ -0,0 +1,33 @@
+"""
+Reader for the per-host session thread counts saved by the cyclegan autotune
+phase (main.py --phase autotune): a JSON file, by default
+~/.cycleda/thread_config.json or $CYCLEDA_THREAD_CONFIG, keyed by host name.
+"""
+from __future__ import division
+from __future__ import print_function
+import json
+import os
+import socket
+
+THREAD_CONFIG_PATH = os.environ.get('CYCLEDA_THREAD_CONFIG',
+                                    os.path.join(os.path.expanduser('~'), '.cycleda', 'thread_config.json'))
+
+
+def apply_thread_config(config, path=THREAD_CONFIG_PATH):
+  """Set the tuned thread counts of this host on a tf.ConfigProto.
+
+  Args:
+   config: tf.ConfigProto, left unchanged if the host was never tuned
+   path: JSON file written by the autotune phase
+
+  Returns:
+   config
+  """
+  if not os.path.exists(path):
+    return config
+  with open(path) as f:
+    threads = json.load(f).get(socket.gethostname())
+  if threads:
+    config.intra_op_parallelism_threads = threads['intra_op_parallelism_threads']
+    config.inter_op_parallelism_threads = threads['inter_op_parallelism_threads']
+  return config
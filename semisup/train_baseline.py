@@ -33,6 +33,7 @@ import tensorflow as tf
 import tensorflow.contrib.slim as slim
 from tensorflow.python.platform import app
 from tensorflow.python.platform import flags
+from tools.thread_config import apply_thread_config
 from tensorflow.python.training import saver as tf_saver
 
 # train
@@ -310,6 +311,7 @@ def main(argv):
             train_op = model.create_train_op(t_learning_rate)
 
             config = tf.ConfigProto()
+            apply_thread_config(config)
             config.gpu_options.allow_growth = True
             config.log_device_placement = True
             saver = tf.train.Saver(var_list=tf.trainable_variables(),
@@ -2,11 +2,24 @@
 Some codes from https://github.com/Newmu/dcgan_code
 """
 from __future__ import division
+import atexit
+import json
 import math
+import os
 import pprint
+import shutil
+import socket
+import sys
+import threading
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import scipy.io
 import scipy.misc
 import numpy as np
-import copy
 from PIL import Image
 
 pp = pprint.PrettyPrinter()
@@ -15,29 +28,181 @@ get_stddev = lambda x, k_h, k_w: 1/math.sqrt(k_w*k_h*x.get_shape()[-1])
 
 # -----------------------------
 # new added functions for cyclegan
+def encode_images(images, dtype):
+    """Images in [-1, 1] as dtype: float32, float16, or uint8."""
+    dtype = np.dtype(dtype)
+    if dtype == np.uint8:
+        return np.round((np.clip(images, -1., 1.) + 1.) * 127.5).astype(np.uint8)
+    return images.astype(dtype)
+
+def decode_images(images):
+    """Float32 images in [-1, 1] from encode_images output."""
+    if images.dtype == np.uint8:
+        return images.astype(np.float32) / 127.5 - 1.
+    return images.astype(np.float32)
+
 class ImagePool(object):
-    def __init__(self, maxsize=50):
+    """History of generated images, one preallocated array per domain.
+
+    Holds up to maxsize images per domain. Until a domain is full every incoming
+    image is stored and returned as is; afterwards each image replaces a random
+    slot half of the time and the image previously in that slot is returned.
+    dtype sets the storage precision: float32, float16, or uint8 (images are
+    in [-1, 1]); returned batches are always float32.
+    """
+    def __init__(self, maxsize=50, dtype='float32'):
         self.maxsize = maxsize
-        self.num_img = 0
+        self.dtype = np.dtype(dtype)
+        self.num_img = []
         self.images = []
 
+    def _encode(self, images):
+        return encode_images(images, self.dtype)
+
+    def _decode(self, images):
+        return decode_images(images)
+
+    def _allocate(self, domain, shape):
+        return np.zeros((self.maxsize,) + shape, self.dtype)
+
+    def _read(self, domain, slots):
+        return self.images[domain][slots]
+
+    def _write(self, domain, slots, images):
+        self.images[domain][slots] = images
+
+    def _query(self, domain, images):
+        if len(self.images) <= domain:
+            self.images.append(self._allocate(domain, images.shape[1:]))
+            self.num_img.append(0)
+        n = len(images)
+        position = self.num_img[domain] + np.arange(n)
+        filling = position < self.maxsize
+        swap = ~filling & (np.random.rand(n) > 0.5)
+        slot = np.where(filling, position, np.random.randint(0, self.maxsize, n))
+        out = np.array(images, dtype=np.float32)
+        # read the swapped-out images before overwriting their slots
+        out[swap] = self._decode(self._read(domain, slot[swap]))
+        stored = filling | swap
+        self._write(domain, slot[stored], self._encode(images[stored]))
+        self.num_img[domain] = min(self.num_img[domain] + n, self.maxsize)
+        return out
+
     def __call__(self, image):
         if self.maxsize <= 0:
             return image
-        if self.num_img < self.maxsize:
-            self.images.append(image)
-            self.num_img += 1
-            return image
-        if np.random.rand() > 0.5:
-            idx = int(np.random.rand()*self.maxsize)
-            tmp1 = copy.copy(self.images[idx])[0]
-            self.images[idx][0] = image[0]
-            idx = int(np.random.rand()*self.maxsize)
-            tmp2 = copy.copy(self.images[idx])[1]
-            self.images[idx][1] = image[1]
-            return [tmp1, tmp2]
-        else:
-            return image
+        return [self._query(domain, images) for domain, images in enumerate(image)]
+
+    def state(self, path):
+        """Pool contents as a dict of arrays in the storage dtype, for the checkpoint at path."""
+        state = {'pool_num_img': np.array(self.num_img, np.int64)}
+        for domain, n in enumerate(self.num_img):
+            state['pool_images_{0}'.format(domain)] = self.images[domain][:n].copy()
+        return state
+
+    def restore(self, state, path):
+        """Refill the pool from what state wrote for the checkpoint at path."""
+        for domain, n in enumerate(state['pool_num_img']):
+            images = state['pool_images_{0}'.format(domain)]
+            if len(self.images) <= domain:
+                self.images.append(self._allocate(domain, images.shape[1:]))
+                self.num_img.append(0)
+            self._write(domain, np.arange(n), images)
+            self.num_img[domain] = int(n)
+
+class DiskImagePool(ImagePool):
+    """ImagePool whose slots live in a memory-mapped .npy file under pool_dir.
+
+    Newly stored images first go to an in-RAM hot set of hot_size images, and
+    reads of those slots are served from it. When the hot set is full it is
+    written to the file in slot order in one pass. Reads of other slots go
+    through the page cache. The files are deleted by close, and at exit.
+    """
+    def __init__(self, maxsize=50, dtype='float32', pool_dir='./pool', hot_size=4096):
+        super(DiskImagePool, self).__init__(maxsize, dtype)
+        self.pool_dir = pool_dir
+        self.hot_size = max(hot_size, 1)
+        self.paths = []
+        self.hot = []
+        self.hot_slots = []
+        self.hot_index = []
+        self.num_hot = []
+        atexit.register(self.close)
+
+    def _allocate(self, domain, shape):
+        if not os.path.exists(self.pool_dir):
+            os.makedirs(self.pool_dir)
+        path = os.path.join(self.pool_dir, 'pool_{0}_{1}_{2}.npy'.format(os.getpid(), id(self), domain))
+        self.paths.append(path)
+        self.hot.append(np.zeros((self.hot_size,) + shape, self.dtype))
+        self.hot_slots.append(np.zeros(self.hot_size, np.int64))
+        # slot -> position in the hot set, -1 when the slot is only on disk
+        self.hot_index.append(np.full(self.maxsize, -1, np.int64))
+        self.num_hot.append(0)
+        return np.lib.format.open_memmap(path, mode='w+', dtype=self.dtype, shape=(self.maxsize,) + shape)
+
+    def _read(self, domain, slots):
+        images = self.images[domain][np.sort(slots)][np.argsort(np.argsort(slots))]
+        position = self.hot_index[domain][slots]
+        in_hot = position >= 0
+        images[in_hot] = self.hot[domain][position[in_hot]]
+        return images
+
+    def _write(self, domain, slots, images):
+        # a slot picked twice in one batch keeps its last image, as with plain indexing
+        _, last = np.unique(slots[::-1], return_index=True)
+        keep = len(slots) - 1 - last
+        slots, images = slots[keep], images[keep]
+        position = self.hot_index[domain][slots]
+        in_hot = position >= 0
+        self.hot[domain][position[in_hot]] = images[in_hot]
+        slots, images = slots[~in_hot], images[~in_hot]
+        if self.num_hot[domain] + len(slots) > self.hot_size:
+            self._flush(domain)
+        if len(slots) > self.hot_size:
+            self.images[domain][slots] = images
+            return
+        position = self.num_hot[domain] + np.arange(len(slots))
+        self.hot[domain][position] = images
+        self.hot_slots[domain][position] = slots
+        self.hot_index[domain][slots] = position
+        self.num_hot[domain] += len(slots)
+
+    def _flush(self, domain):
+        n = self.num_hot[domain]
+        slots = self.hot_slots[domain][:n]
+        order = np.argsort(slots)
+        self.images[domain][slots[order]] = self.hot[domain][:n][order]
+        self.hot_index[domain][slots] = -1
+        self.num_hot[domain] = 0
+
+    def state(self, path):
+        """Copy each pool file to <path>.pool_<domain>.npy instead of reading it into memory."""
+        for domain in range(len(self.images)):
+            self._flush(domain)
+            self.images[domain].flush()
+            # a copy, not a hardlink: the pool file keeps changing in place
+            shutil.copyfile(self.paths[domain], '{0}.pool_{1}.npy'.format(path, domain))
+        return {'pool_num_img': np.array(self.num_img, np.int64)}
+
+    def restore(self, state, path):
+        for domain, n in enumerate(state['pool_num_img']):
+            images = np.load('{0}.pool_{1}.npy'.format(path, domain), mmap_mode='r')
+            if len(self.images) <= domain:
+                self.images.append(self._allocate(domain, images.shape[1:]))
+                self.num_img.append(0)
+            self._flush(domain)
+            # hot_size images at a time, so the pool never has to fit in memory
+            for start in range(0, n, self.hot_size):
+                end = min(start + self.hot_size, n)
+                self.images[domain][start:end] = images[start:end]
+            self.num_img[domain] = int(n)
+
+    def close(self):
+        for path in self.paths:
+            if os.path.exists(path):
+                os.remove(path)
+        self.paths = []
 
 def load_test_data(image_path, is_gray_scale=False, fine_size=256):
     img = imread(image_path, is_grayscale=is_gray_scale)
@@ -45,6 +210,12 @@ def load_test_data(image_path, is_gray_scale=False, fine_size=256):
     img = img/127.5 - 1
     return img
 
+def load_test_batch(image_paths, is_gray_scale=False, fine_size=256):
+    batch_images = np.array([load_test_data(image_path, is_gray_scale, fine_size) for image_path in image_paths])
+    if batch_images.ndim == 3:
+        batch_images = np.expand_dims(batch_images, axis=3)
+    return batch_images.astype(np.float32)
+
 def load_train_data(image_path, load_size=286, fine_size=256, is_testing=False):
     img_A = imread(image_path[0], is_grayscale=True)
     img_B = imread(image_path[1])
@@ -61,9 +232,392 @@ def load_train_data(image_path, load_size=286, fine_size=256, is_testing=False):
     # img_AB shape: (fine_size, fine_size, input_c_dim + output_c_dim)
     return img_AB
 
+def load_train_batch(batch_files, load_size=286, fine_size=256, is_testing=False, as_uint8=False):
+    if as_uint8:
+        # raw pixels; the model casts and normalizes them in the graph
+        return np.array([np.concatenate((decode_image(batch_file[0], fine_size, is_grayscale=True),
+                                         decode_image(batch_file[1], fine_size)), axis=2)
+                         for batch_file in batch_files])
+    batch_images = [load_train_data(batch_file, load_size, fine_size, is_testing) for batch_file in batch_files]
+    return np.array(batch_images).astype(np.float32)
+
+class BatchPrefetcher(object):
+    """Assemble upcoming batches in a worker pool while the current step runs.
+
+    Each element of `jobs` is an argument tuple for `load_fn`; batches are
+    yielded in job order. At most `queue_size` batches are in flight.
+    A process pool needs a picklable `load_fn` and cheap-to-pickle arguments.
+    """
+    def __init__(self, load_fn, jobs, num_workers=4, queue_size=8, use_processes=False):
+        self._pool = (Pool if use_processes else ThreadPool)(max(num_workers, 1))
+        self._queue = queue.Queue(maxsize=max(queue_size, 1))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._produce, args=(load_fn, jobs))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, load_fn, jobs):
+        for job in jobs:
+            if not self._put(self._pool.apply_async(load_fn, job)):
+                return
+        self._put(None)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        result = self._queue.get()
+        if result is None:
+            self.close()
+            raise StopIteration
+        return result.get()
+
+    next = __next__
+
+    def close(self):
+        self._stop.set()
+        self._pool.terminate()
+
+# -----------------------------
+# persistent file manifest of the train/test domains
+# split name -> (images are grouped in class subfolders, is_grayscale)
+DATASET_SPLITS = {
+    'trainA': (True, True),
+    'trainB': (False, False),
+    'testA': (True, True),
+    'testB': (False, False),
+}
+
+def _scan_png_dir(dirpath, known):
+    """List the .png files of one directory, only stat-ing the ones not already known."""
+    entries = []
+    for name in sorted(os.listdir(dirpath)):
+        if not name.endswith('.png'):
+            continue
+        path = os.path.join(dirpath, name)
+        if path in known:
+            entries.append(known[path])
+        else:
+            st = os.stat(path)
+            entries.append([path, st.st_size, st.st_mtime])
+    return entries
+
+def load_manifest(dataset_dir, split, manifest_dir):
+    """Return the sorted image paths and labels of a split, without walking the whole tree.
+
+    The listing (path, class subfolder, size, mtime) is kept in
+    <manifest_dir>/<split>_manifest.json. On later calls only directories whose
+    mtime changed are listed again, so files added, removed or renamed since the
+    last run are picked up while unchanged class folders are reused as they are.
+    """
+    is_nested = DATASET_SPLITS[split][0]
+    root = os.path.join(dataset_dir, split)
+    manifest_path = os.path.join(manifest_dir, '{0}_manifest.json'.format(split))
+    manifest = {'root': root, 'root_mtime': None, 'dirs': {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            stored = json.load(f)
+        if stored['root'] == root:
+            manifest = stored
+
+    changed = False
+    if is_nested:
+        root_mtime = os.stat(root).st_mtime
+        if manifest['root_mtime'] != root_mtime:
+            subfolders = sorted(d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d)))
+            for subfolder in set(manifest['dirs']) - set(subfolders):
+                del manifest['dirs'][subfolder]
+            manifest['root_mtime'] = root_mtime
+            changed = True
+        else:
+            subfolders = sorted(manifest['dirs'])
+    else:
+        subfolders = ['']
+
+    for subfolder in subfolders:
+        dirpath = os.path.join(root, subfolder)
+        mtime = os.stat(dirpath).st_mtime
+        entry = manifest['dirs'].get(subfolder)
+        if entry is None or entry['mtime'] != mtime:
+            known = dict((f[0], f) for f in entry['files']) if entry else {}
+            manifest['dirs'][subfolder] = {'mtime': mtime, 'files': _scan_png_dir(dirpath, known)}
+            changed = True
+
+    if changed:
+        if not os.path.exists(manifest_dir):
+            os.makedirs(manifest_dir)
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.rename(manifest_path + '.tmp', manifest_path)
+
+    paths = [f[0] for subfolder in sorted(manifest['dirs']) for f in manifest['dirs'][subfolder]['files']]
+    return np.array(paths), np.array([image_label(p) for p in paths], dtype=np.int64)
+
+# -----------------------------
+# decoded uint8 cache of the train/test domains
+
+def decode_image(image_path, fine_size=256, is_grayscale=False):
+    """Decode and resize one image to a uint8 [fine_size, fine_size, c] array."""
+    img = scipy.misc.imresize(imread(image_path, is_grayscale=is_grayscale), [fine_size, fine_size])
+    if img.ndim == 2:
+        img = np.expand_dims(img, 2)
+    return img
+
+def cache_paths(cache_dir, split, fine_size):
+    prefix = os.path.join(cache_dir, '{0}_{1}'.format(split, fine_size))
+    return prefix + '.npy', prefix + '_index.npz'
+
+def image_label(image_path):
+    """Class label of an image stored as <domain>/<label>/<name>.png, -1 if unlabeled."""
+    subfolder_name = os.path.split(os.path.dirname(image_path))[-1]
+    return int(subfolder_name) if subfolder_name.isdigit() else -1
+
+def build_dataset_cache(dataset_dir, cache_dir, fine_size=256, splits=None):
+    """Decode every image of the given splits once into a memory-mappable uint8 array.
+
+    For each split this writes <split>_<fine_size>.npy with shape [N, fine_size, fine_size, c]
+    and a sidecar <split>_<fine_size>_index.npz holding the source paths and labels,
+    in manifest order. Splits whose sidecar already lists the same files are left untouched.
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    for split in (splits or sorted(DATASET_SPLITS)):
+        is_grayscale = DATASET_SPLITS[split][1]
+        files = list(load_manifest(dataset_dir, split, cache_dir)[0])
+        data_path, index_path = cache_paths(cache_dir, split, fine_size)
+        if os.path.exists(data_path) and os.path.exists(index_path):
+            if list(np.load(index_path)['paths']) == files:
+                continue
+        if not files:
+            print(' [!] No images found for {0} in {1}'.format(split, dataset_dir))
+            continue
+        print(' [*] Caching {0} images of {1}...'.format(len(files), split))
+        first = decode_image(files[0], fine_size, is_grayscale)
+        images = np.lib.format.open_memmap(data_path + '.tmp', mode='w+', dtype=np.uint8,
+                                           shape=(len(files),) + first.shape)
+        images[0] = first
+        for i in range(1, len(files)):
+            images[i] = decode_image(files[i], fine_size, is_grayscale)
+        images.flush()
+        del images
+        os.rename(data_path + '.tmp', data_path)
+        np.savez(index_path, paths=np.array(files),
+                 labels=np.array([image_label(f) for f in files], dtype=np.int64))
+
+def load_dataset_cache(cache_dir, split, fine_size=256):
+    """Open a cached split as (read-only memmap images, paths, labels)."""
+    data_path, index_path = cache_paths(cache_dir, split, fine_size)
+    index = np.load(index_path)
+    return np.load(data_path, mmap_mode='r'), list(index['paths']), index['labels']
+
+def load_cached_batch(images_A, images_B, idx_A, idx_B, as_uint8=False):
+    """Gather a normalized [batch, h, w, c_A + c_B] float32 batch from cached uint8 arrays.
+
+    With as_uint8 the raw pixels are returned instead.
+    """
+    batch = np.concatenate((images_A[idx_A], images_B[idx_B]), axis=3)
+    if as_uint8:
+        return batch
+    return batch.astype(np.float32)/127.5 - 1.
+
+# -----------------------------
+# sharded uint8 arrays of translated test images
+def mat_labels(label_file, image_paths, start_idx=1):
+    """Look up labels of images named <index>.png in the 'y' field of a .mat file (SVHN layout)."""
+    labels = scipy.io.loadmat(label_file)['y'].ravel() % 10
+    return labels[[int(os.path.splitext(os.path.basename(p))[0]) - start_idx for p in image_paths]]
+
+class ImageShardWriter(object):
+    """Collect translated images into uint8 arrays of `shard_size` images.
+
+    Shards are saved as <prefix>_shard_<k>.npy, through `writer` when one is given.
+    close writes the remaining images and the <prefix>_shards.npz index holding the
+    shard names and sizes and the filename and label of every image, in the order
+    they were added. load_image_shards reads the result back.
+    """
+    def __init__(self, prefix, shard_size=10000, writer=None):
+        self.prefix = prefix
+        self.shard_size = max(shard_size, 1)
+        self.writer = writer
+        self.shards = []
+        self.shard_sizes = []
+        self.filenames = []
+        self.labels = []
+        self._pending = []
+        self._num_pending = 0
+
+    def add(self, images, filenames, labels):
+        self._pending.append(inverse_transform(images))
+        self._num_pending += len(images)
+        self.filenames.extend(filenames)
+        self.labels.extend(labels)
+        while self._num_pending >= self.shard_size:
+            self._write_shard()
+
+    def _write_shard(self):
+        images = np.concatenate(self._pending)
+        shard, rest = images[:self.shard_size], images[self.shard_size:]
+        self._pending = [rest] if len(rest) else []
+        self._num_pending = len(rest)
+        path = '{0}_shard_{1:05d}.npy'.format(self.prefix, len(self.shards))
+        if self.writer is not None:
+            self.writer.submit(np.save, (path, shard), path)
+        else:
+            np.save(path, shard)
+        self.shards.append(os.path.basename(path))
+        self.shard_sizes.append(len(shard))
+
+    def close(self):
+        if self._num_pending:
+            self._write_shard()
+        # the index must only list shards that are on disk
+        if self.writer is not None:
+            self.writer.flush()
+        np.savez(self.prefix + '_shards.npz', shards=np.array(self.shards),
+                 shard_sizes=np.array(self.shard_sizes, dtype=np.int64),
+                 filenames=np.array(self.filenames), labels=np.array(self.labels, dtype=np.int64))
+
+def load_image_shards(index_path):
+    """Read an ImageShardWriter export as (uint8 images, filenames, labels)."""
+    index = np.load(index_path)
+    shard_dir = os.path.dirname(index_path)
+    images = np.concatenate([np.load(os.path.join(shard_dir, shard)) for shard in index['shards']])
+    return images, index['filenames'], index['labels']
+
+# -----------------------------
+# process statistics for the benchmark phases
+def peak_memory_mb():
+    """Peak resident set size of this process in MB (0 where the resource module is missing)."""
+    try:
+        import resource
+    except ImportError:
+        return 0.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024. * 1024.) if sys.platform == 'darwin' else peak / 1024.
+
+# -----------------------------
+# per-host session thread counts found by --phase autotune
+THREAD_CONFIG_PATH = os.environ.get('CYCLEDA_THREAD_CONFIG',
+                                    os.path.join(os.path.expanduser('~'), '.cycleda', 'thread_config.json'))
+
+def _read_thread_configs(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def load_thread_config(path=THREAD_CONFIG_PATH):
+    """Return the tuned thread settings of this host as a dict, or None if it was never tuned."""
+    return _read_thread_configs(path).get(socket.gethostname())
+
+def save_thread_config(intra_op, inter_op, images_per_sec, path=THREAD_CONFIG_PATH):
+    """Record the thread settings of this host, keeping the entries of other hosts."""
+    configs = _read_thread_configs(path)
+    configs[socket.gethostname()] = {'intra_op_parallelism_threads': int(intra_op),
+                                     'inter_op_parallelism_threads': int(inter_op),
+                                     'images_per_sec': float(images_per_sec)}
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path + '.tmp', 'w') as f:
+        json.dump(configs, f, indent=1, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+def apply_thread_config(tfconfig, path=THREAD_CONFIG_PATH):
+    """Set the tuned thread counts of this host on a tf.ConfigProto, if there are any."""
+    threads = load_thread_config(path)
+    if threads:
+        tfconfig.intra_op_parallelism_threads = threads['intra_op_parallelism_threads']
+        tfconfig.inter_op_parallelism_threads = threads['inter_op_parallelism_threads']
+    return tfconfig
+
 def save_images(images, size, image_path):
     return imsave(inverse_transform(images), size, image_path)
 
+def save_image_grids(jobs, pool):
+    """Compose and encode several (images, size, image_path) grids concurrently on a ThreadPool."""
+    pool.map(lambda job: save_images(*job), jobs)
+
+class BackgroundWriter(object):
+    """Run image (and other output) writes in background worker threads.
+
+    save/submit return as soon as the work is queued; once `queue_size` writes
+    are pending they block. The first failed write is re-raised by the next call
+    to save, submit, flush or close, and pending writes are flushed at interpreter exit.
+    """
+    def __init__(self, num_workers=2, queue_size=256):
+        self._queue = queue.Queue(maxsize=max(queue_size, 1))
+        self._error = None
+        self._closed = False
+        self._num_workers = max(num_workers, 1)
+        self._grid_pool = None
+        self._grid_lock = threading.Lock()
+        self._workers = [threading.Thread(target=self._work) for _ in range(max(num_workers, 1))]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+        atexit.register(self.close)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                item[0](*item[1])
+            except Exception as e:
+                if self._error is None:
+                    self._error = IOError('Failed to write {0}: {1}'.format(item[2], e))
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def submit(self, write_fn, args, description=''):
+        self._raise_error()
+        self._queue.put((write_fn, args, description))
+
+    def save(self, images, size, image_path):
+        self.submit(save_images, (images, size, image_path), image_path)
+
+    def save_grids(self, jobs):
+        self.submit(self._save_grids, (jobs,), ', '.join(job[2] for job in jobs))
+
+    def _save_grids(self, jobs):
+        # created on first use, since most writers never save grids
+        with self._grid_lock:
+            if self._grid_pool is None:
+                self._grid_pool = ThreadPool(self._num_workers)
+        save_image_grids(jobs, self._grid_pool)
+
+    def flush(self):
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        if self._grid_pool is not None:
+            self._grid_pool.close()
+        self._raise_error()
+
 def imread(path, is_grayscale = False):
     if (is_grayscale):
         # return scipy.misc.imread(path, flatten = True).astype(np.float)
@@ -78,23 +632,15 @@ def imread(path, is_grayscale = False):
 #     return inverse_transform(images)
 
 def merge(images, size):
-    h, w, c = images.shape[1], images.shape[2], images.shape[3]
-    
+    """Tile a [n, h, w, c] batch into a size[0] x size[1] grid with one reshape/transpose."""
+    n, h, w, c = images.shape
+    rows, cols = size
+    if n < rows * cols:
+        images = np.concatenate((images, np.zeros((rows * cols - n, h, w, c), dtype=images.dtype)))
+    img = images[:rows * cols].reshape(rows, cols, h, w, c).transpose(0, 2, 1, 3, 4)
+    img = img.reshape(rows * h, cols * w, c).astype(np.uint8)
     if c == 1:
-        img = np.zeros((h * size[0], w * size[1]), dtype=np.uint8)
-    else:
-        img = np.zeros((h * size[0], w * size[1], c), dtype=np.uint8)
-
-    for idx, image in enumerate(images):
-        i = idx % size[1]
-        j = idx // size[1]
-        
-        if c == 1:
-            image = np.squeeze(image, axis = 2)
-            img[j*h:j*h+h, i*w:i*w+w] = image
-        else:
-            img[j*h:j*h+h, i*w:i*w+w, :] = image
-
+        img = img[:, :, 0]
     return img
 
 def imsave(images, size, path):
@@ -120,4 +666,4 @@ def center_crop(x, crop_h, crop_w,
 
 def inverse_transform(images):
     #print((images+1.)*127.5)
-    return (images+1.)*127.5
\ No newline at end of file
+    return np.clip((images+1.)*127.5, 0, 255).astype(np.uint8)
\ No newline at end of file